@@ -0,0 +1,136 @@
+import os
+import numpy as np
+import startup
+
+plt = startup.lazy_import("matplotlib.pyplot")
+fits = startup.lazy_import("astropy.io.fits")
+axes_grid1 = startup.lazy_import("mpl_toolkits.axes_grid1")
+
+
+# FOLLOWING: Constants
+ASEC_SPACING = 6  # Tick spacing on the image axes (arcsec)
+EXT_FLUX_SPACING = .0002  # Colorbar tick spacing for the extended maps (Jy/beam)
+NUC_FLUX_SPACING = .005  # Colorbar tick spacing for the nuclear map (Jy/beam)
+CUTOUT_SIZE = 30  # Width of the central cutout shown from each map (arcsec), None for the whole map
+MAX_PREVIEW_PIXELS = 1000  # Cutouts wider than this are shown downsampled to about this many pixels
+COLORMAP = "pink"
+PRODUCTS = {  # File name endings of the ALMA continuum maps, after the galaxy's name without spaces
+    "ALMANuclearNat.fits": "nuclear",
+    "ALMAExtendedLowerNat.fits": "lower",
+    "ALMAExtendedUpperNat.fits": "upper",
+    "ALMAExtendedNoiseNat.fits": "noise"
+}
+
+
+# FOLLOWING: FITS loading
+
+def read_plane(location, cutout_size=CUTOUT_SIZE, max_pixels=MAX_PREVIEW_PIXELS):
+    # Reads the first plane of a FITS map (e.g. data[0][0] of a Stokes/frequency cube) and returns a central cutout
+    # cutout_size arcsec wide, along with its imshow extent in arcsec.  The file is memory-mapped, so only the pixels
+    # in the cutout are read, and it's closed before returning.  Cutouts wider than max_pixels are downsampled by
+    # taking every nth pixel.
+
+    with fits.open(location, memmap=True, do_not_scale_image_data=True) as hdul:
+        header = hdul[0].header
+        data = hdul[0].data
+        while data.ndim > 2:
+            data = data[0]
+
+        # Pixels are square, with CDELT2 degrees on a side
+        pixel_size = 3600 * abs(header['CDELT2'])
+        rows, cols = data.shape
+        if cutout_size is not None:
+            half_width = int(np.ceil(cutout_size / (2 * pixel_size)))
+            row_start, row_end = max(rows // 2 - half_width, 0), min(rows // 2 + half_width, rows)
+            col_start, col_end = max(cols // 2 - half_width, 0), min(cols // 2 + half_width, cols)
+        else:
+            row_start, row_end, col_start, col_end = 0, rows, 0, cols
+        step = max(1, int(np.ceil(max(row_end - row_start, col_end - col_start) / max_pixels)))
+
+        # Copy the cutout out of the memory map (scaling it by hand, since scaling on open would read the whole map)
+        image = np.array(data[row_start:row_end:step, col_start:col_end:step], dtype=float)
+        image = image * header.get('BSCALE', 1) + header.get('BZERO', 0)
+        del data
+
+    half_x = (col_end - col_start) * pixel_size / 2
+    half_y = (row_end - row_start) * pixel_size / 2
+    return image, (half_x, -half_x, -half_y, half_y)
+
+
+def scan_fits(fits_loc):
+    # Lists fits_loc once and returns {galaxy name without spaces: {product: path}} for every file ending in one of
+    # PRODUCTS
+    index = {}
+    for entry in os.scandir(fits_loc):
+        for ending, product in PRODUCTS.items():
+            if entry.name.endswith(ending):
+                index.setdefault(entry.name[:-len(ending)], {})[product] = entry.path
+    return index
+
+
+def panel_files(galaxy_name, index):
+    # Returns the nuclear, lower extended and upper extended maps of a galaxy from a scan_fits index, using the
+    # extended noise map for both extended maps if there aren't separate ones.  Returns None if any are missing.
+    products = index.get(galaxy_name.replace(" ", ""), {})
+    if "nuclear" not in products:
+        return None
+    if "lower" in products and "upper" in products:
+        return products["nuclear"], products["lower"], products["upper"]
+    if "noise" in products:
+        return products["nuclear"], products["noise"], products["noise"]
+    return None
+
+
+def missing_products(galaxy_name, index):
+    # Describes which maps keep a galaxy from having a panel figure
+    products = index.get(galaxy_name.replace(" ", ""), {})
+    missing = []
+    if "nuclear" not in products:
+        missing.append("nuclear")
+    if not ("lower" in products and "upper" in products) and "noise" not in products:
+        missing.append("extended (lower/upper or noise)")
+    return missing
+
+
+# FOLLOWING: Panel figure
+
+def render_panel(g, save_folder, files, show=True):
+    # Plots the SED of a galaxy above its nuclear and extended ALMA continuum maps (the paths given by panel_files),
+    # and saves it in save_folder.  Returns the saved file.
+
+    # Put SED on the top
+    fig, axs = plt.subplots(2, 3)
+    axs[0, 0] = plt.subplot2grid((3, 2), (0, 0), colspan=3)
+    axs[0, 0] = g.display_sed(give_as_subplot=True, scaling=.7)
+
+    # Put the images on the bottom, each with a colorbar above it
+    flux_spacings = (NUC_FLUX_SPACING, EXT_FLUX_SPACING, EXT_FLUX_SPACING)
+    for i, location in enumerate(files):
+        image, extent = read_plane(location)
+        mapfig = axs[1, i].imshow(image, cmap=COLORMAP, extent=extent)
+        axs[1, i].set_xticks((-ASEC_SPACING, 0, ASEC_SPACING))
+        axs[1, i].set_yticks((-ASEC_SPACING, 0, ASEC_SPACING))
+
+        spacing = flux_spacings[i]
+        if i == 0:
+            ticks = (0, spacing, 2*spacing, 3*spacing, 4*spacing)
+            tick_labels = ['0', 1000*spacing, 2*1000*spacing, 3*1000*spacing, 4*1000*spacing]
+        else:
+            ticks = (-2*spacing, -spacing, 0, spacing, 2*spacing)
+            tick_labels = [-2*spacing*1000, -spacing*1000, '0.0', spacing*1000, 2*spacing*1000]
+        cax = axes_grid1.make_axes_locatable(axs[1, i]).append_axes("top", size="10%", pad=0.3)
+        cbar = plt.colorbar(mapfig, cax=cax, orientation="horizontal", ticks=ticks)
+        cbar.ax.tick_params(top=True, bottom=False, pad=-30)
+        cbar.ax.set_xlabel("Flux (mJy/beam)", fontdict={'fontsize': 8.5})
+        cbar.ax.set_xticklabels(tick_labels)
+
+    plt.setp(axs[1, 0], ylabel=r"$\Delta$ decl. (arcsec)")
+    plt.setp(axs[1, 1], xlabel=r"$\Delta$ R.A. (arcsec)")
+
+    save_location = os.path.join(save_folder, g.name.replace(" ", "") + "_sed_w_alma_images.png")
+    plt.savefig(save_location, dpi=500)
+    if show:
+        plt.show()
+    else:
+        plt.close(fig)
+    return save_location
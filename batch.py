@@ -0,0 +1,236 @@
+import os
+import json
+import collections
+from concurrent.futures import ProcessPoolExecutor
+import matplotlib
+import startup
+import spreadsheet_interface as spin
+import alma_panel
+import grid_plot
+import sed_template
+
+plt = startup.lazy_import("matplotlib.pyplot")
+
+
+# FOLLOWING: Results
+
+class TargetResult:
+    # The outcome of one target in a batch run.  'output' is the file written on success, 'error' describes what went
+    # wrong otherwise.
+
+    def __init__(self, name, ok, output=None, error=None):
+        self.name = name
+        self.ok = ok
+        self.output = output
+        self.error = error
+
+    def __str__(self):
+        if self.ok:
+            return self.name + ": OK (" + str(self.output) + ")"
+        return self.name + ": FAILED (" + str(self.error) + ")"
+
+
+def print_report(results):
+    failures = [result for result in results if not result.ok]
+    print("\n" + str(len(results) - len(failures)) + " of " + str(len(results)) + " targets succeeded")
+    for result in failures:
+        print("\t" + str(result))
+
+
+# FOLLOWING: Worker processes
+
+_sed_template = None  # SedTemplate reused by _render_sed in this process
+
+def _init_worker(backend):
+    # Workers never show figures, and use the parent's storage backend (for the workbook, the copy already parsed by
+    # the parent instead of reading it again)
+    matplotlib.use('Agg')
+    spin.use_backend(backend)
+
+
+def _pool(jobs):
+    return ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker, initargs=(spin.backend(),))
+
+
+def _render_sed(target, save_folder):
+    # Renders a target given by name or as a Galaxy.  Each worker keeps one SedTemplate and only redraws the galaxy's
+    # data on it.
+    global _sed_template
+
+    name = target if isinstance(target, str) else target.name
+    try:
+        if _sed_template is None:
+            _sed_template = sed_template.SedTemplate()
+        g = spin.get_set_named(target) if isinstance(target, str) else target
+        return TargetResult(name, True, output=_sed_template.save(g, os.path.join(save_folder, "sed_" + name + ".png")))
+    except Exception as e:
+        if _sed_template is not None:
+            _sed_template.close()
+            _sed_template = None
+        return TargetResult(name, False, error=type(e).__name__ + ": " + str(e))
+
+
+def _render_alma_panel(name, files, save_folder):
+    try:
+        g = spin.get_set_named(name)
+        return TargetResult(name, True, output=alma_panel.render_panel(g, save_folder, files, show=False))
+    except Exception as e:
+        return TargetResult(name, False, error=type(e).__name__ + ": " + str(e))
+    finally:
+        plt.close('all')
+
+
+def _render_grid_page(names, save_location, rows, cols, bold):
+    try:
+        return TargetResult(save_location, True, output=grid_plot.save_page(names, save_location, rows=rows,
+                                                                             cols=cols, bold=bold))
+    except Exception as e:
+        return TargetResult(save_location, False, error=type(e).__name__ + ": " + str(e))
+
+
+def _fit_target(spec):
+    name = spec["name"]
+    fit_type = spec.get("model", "mod_blackbody")
+
+    try:
+        g = spin.get_set_named(name)
+        fit_range = list(spec.get("range", [0, len(g.freq)])) + sorted(spec.get("exclude", []))
+        params, fit_range, percentiles = g.compute_fit(fit_range, hold=list(spec.get("hold", [0, 0, 0])),
+                                                       fit_type=fit_type, subtract=spec.get("subtract", False),
+                                                       verbose=False, realizations=spec.get("realizations", 0),
+                                                       jobs=1, seed=spec.get("seed"))
+        return TargetResult(name, True, output=(fit_type, params, fit_range, spec.get("linestyle", "solid"),
+                                                percentiles))
+    except Exception as e:
+        return TargetResult(name, False, error=type(e).__name__ + ": " + str(e))
+
+
+# FOLLOWING: Fit specs
+
+def read_job_file(location):
+    # Reads a JSON or, if it ends in .yaml/.yml, YAML file (which needs PyYAML)
+    with open(location) as f:
+        if os.path.splitext(location)[1].lower() in (".yaml", ".yml"):
+            import yaml
+            return yaml.safe_load(f)
+        return json.load(f)
+
+
+def load_fit_specs(location):
+    # Reads fit specs from a JSON or YAML file (see read_job_file).  The file holds either a list of specs, or an
+    # object with "defaults" (applied to every spec) and "targets" (specs or plain galaxy names, every galaxy if left
+    # out).  A spec looks like
+    #     {"name": "NGC 612", "model": "mod_blackbody", "range": [0, 12], "exclude": [4], "hold": [0, 0, 1.8],
+    #      "linestyle": "solid", "subtract": false, "replace": true, "realizations": 1000, "seed": 1}
+    # where only "name" is required, "range" defaults to every point, "replace" clears the galaxy's saved fits of
+    # the same model before saving the new one, and "realizations" adds Monte Carlo percentiles of the parameters.
+    return expand_fit_specs(read_job_file(location))
+
+
+def expand_fit_specs(contents):
+    if isinstance(contents, list):
+        contents = {"targets": contents}
+    defaults = contents.get("defaults", {})
+    targets = contents.get("targets")
+    if targets is None:
+        targets = spin.target_list()
+
+    specs = []
+    for target in targets:
+        spec = dict(defaults)
+        if isinstance(target, str):
+            spec["name"] = target
+        else:
+            spec.update(target)
+        specs.append(spec)
+    return specs
+
+
+# FOLLOWING: Batch jobs
+
+def _bounded_map(pool, function, items, window, *args):
+    # Yields function(item, *args) for each item, run on the pool with at most 'window' items submitted but not yet
+    # collected, so items can come from a generator without all being held at once
+    pending = collections.deque()
+    for item in items:
+        pending.append(pool.submit(function, item, *args))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def render_seds(save_folder, names=None, jobs=None, galaxies=None):
+    # Saves the SED of every target in 'names' (all targets by default), or of every Galaxy from the iterable
+    # 'galaxies' (e.g. spin.iter_galaxies or file_read.iter_galaxies), using 'jobs' worker processes (one per CPU by
+    # default).  Galaxies are taken from the iterable only as workers free up.  Returns a TargetResult per target, in
+    # the order given.
+    if galaxies is None:
+        galaxies = spin.target_list() if names is None else names
+    if jobs is None:
+        jobs = os.cpu_count()
+
+    with _pool(jobs) as pool:
+        return list(_bounded_map(pool, _render_sed, galaxies, 4 * jobs, save_folder))
+
+
+def render_alma_panels(save_folder, fits_loc, names=None, jobs=None):
+    # Saves the SED + ALMA image panel figure of every target in 'names' (all targets by default) that has the maps
+    # it needs in fits_loc, which is only listed once, using 'jobs' worker processes.  Returns a TargetResult per
+    # target, in the order given, where targets without maps fail with the ones they're missing.
+    if names is None:
+        names = spin.target_list()
+    index = alma_panel.scan_fits(fits_loc)
+
+    results = {}
+    matched = []
+    for name in names:
+        files = alma_panel.panel_files(name, index)
+        if files is None:
+            results[name] = TargetResult(name, False, error="missing FITS images: " +
+                                                            ", ".join(alma_panel.missing_products(name, index)))
+        else:
+            matched.append((name, files))
+
+    if matched:
+        with _pool(jobs) as pool:
+            futures = [(name, pool.submit(_render_alma_panel, name, files, save_folder)) for name, files in matched]
+            for name, future in futures:
+                results[name] = future.result()
+    return [results[name] for name in names]
+
+
+def render_sed_grid(names, save_location, rows=grid_plot.ROWS, cols=grid_plot.COLS, bold=(), jobs=None):
+    # Saves the SEDs of the named galaxies on grids of rows x cols panels, as many pages as it takes (see
+    # grid_plot.page_location), drawing the pages in 'jobs' worker processes.  Returns a TargetResult per page.
+    name_pages = grid_plot.pages(list(names), rows=rows, cols=cols)
+
+    with _pool(jobs) as pool:
+        futures = []
+        for i in range(len(name_pages)):
+            futures.append(pool.submit(_render_grid_page, name_pages[i],
+                                       grid_plot.page_location(save_location, i, len(name_pages)), rows, cols,
+                                       list(bold)))
+        return [future.result() for future in futures]
+
+
+def fit_galaxies(specs, jobs=None, save=True):
+    # Runs the fit described by each spec (see load_fit_specs) using 'jobs' worker processes, then saves every
+    # successful fit to "Fit Parameters" with a single workbook save.  Returns a TargetResult per spec, whose output
+    # is (fit_type, parameters, fit_range, linestyle, percentiles).
+    with _pool(jobs) as pool:
+        futures = [pool.submit(_fit_target, spec) for spec in specs]
+        results = [future.result() for future in futures]
+
+    new_fits = []
+    cleared = []
+    for i in range(len(specs)):
+        if results[i].ok:
+            fit_type = results[i].output[0]
+            new_fits.append((results[i].name,) + results[i].output)
+            if specs[i].get("replace", False) and (results[i].name, fit_type) not in cleared:
+                cleared.append((results[i].name, fit_type))
+
+    if save:
+        spin.write_fits(new_fits, cleared=cleared)
+    return results
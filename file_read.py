@@ -1,247 +1,204 @@
-import galaxy
+import os
+import csv
+import numpy as np
+import spreadsheet_interface as spin
 
 LINES_PER_DATA_SET = 7
+ENCODING = "utf-8-sig"  # Of the CSV exports (Excel's "CSV UTF-8" starts them with a byte order mark)
 
 
-# Converts a number of the form 6.00E+12 (for example) into an int data type
-def scientific_to_normal(sci_form):
-    final = ""
-    after_decimal = 0
-    hit_decimal = False
-    hit_e = False
-    num_zeros = ""
-    c = 0
-
-    # Get value before E marker
-    while not hit_e:
-        if (sci_form[c] != ".") and (sci_form[c] != "E"):
-            final += sci_form[c]
-            if hit_decimal:
-                after_decimal += 1
-        if sci_form[c] == ".":
-            hit_decimal = True
-        if sci_form[c] == "E":
-            hit_e = True
-            c += 1
-        c += 1
-
-    # Add 0s
-    c -= 1
-    while c < len(sci_form):
-        num_zeros += sci_form[c]
-        c += 1
-    num_zeros = int(num_zeros)
-    num_zeros -= after_decimal
-    if num_zeros > 0:  # If power larger than 0
-        for j in range(num_zeros):
-            final += "0"
-        final = int(final)
-    else:  # If power smaller than 0
-        j = 0
-        final = float(final)
-        while j > num_zeros:
-            final /= 10
-            j -= 1
-
-    return final
-
-
-# Puts data from the nth galaxy data set in a Galaxy class (returns Galaxy)
-def get_set_n(n, curr_file):  # Assumes LINES_PER_DATA_SET (constant) lines of data per galaxy
-    galaxy_name = ""
-    frequency_list = []
-    telescope_list = []
-    flux_list = []
-    unc_upper_list = []
-    unc_lower_list = []
-    curr_line = curr_file.readline()
-    curr_str = ""
-    i = 0  # counter
-    w = 0  # counter to determine width
+# Converts a CSV cell to the value the same cell has in the spreadsheet: None if empty, a float if it's a number, else
+# the string itself (telescope names, 'Limit', 'none')
+def csv_value(cell):
+    cell = cell.strip()
+    if cell == "":
+        return None
+    try:
+        return float(cell)
+    except ValueError:
+        return cell
 
-    # Find nth data set
-    for j in range(n):
-        for k in range(LINES_PER_DATA_SET + 1):
-            curr_line = curr_file.readline()
 
-    # Set constant MAX_WIDTH based on number of commas in this row
-    curr_char = curr_line[i]
-    MAX_WIDTH = len(curr_line) - 1
-
-    # Iterate until galaxy name found
-    while (curr_char == ",") or (curr_char == " ") or (curr_char == "\n") or (curr_char == ""):
-        if i < len(curr_line):
-            curr_char = curr_line[i]
-            i += 1
-        else:
-            i = 0
-            curr_line = curr_file.readline()
-            curr_char = curr_line[i]
-            i += 1
-
-    # Get galaxy name
-    i = 0
-    while curr_char != ",":
-        curr_char = curr_line[i]
-        if curr_char != ",":
-            galaxy_name += curr_char
-        i += 1
-
-    # Iterate until beginning of frequency list
-    i += 1
-    curr_char = curr_line[i]
-    while curr_char != ",":
-        curr_char = curr_line[i]
-        i += 1
-
-    # Populate frequency list
-    curr_char = curr_line[i]
-    while i < (len(curr_line) - (MAX_WIDTH - w)):
-        while (curr_char != ",") and (curr_char != "") and (curr_char != "\n"):
-            curr_char = curr_line[i]
-            if (curr_char != ",") and (curr_char != "") and (curr_char != "\n"):
-                curr_str += curr_char
-            i += 1
-        int_to_add = scientific_to_normal(curr_str)
-        frequency_list.append(int_to_add)
-        w += 1
-        curr_str = ""
-        if i < len(curr_line):
-            curr_char = curr_line[i]
-    curr_line = curr_file.readline()
+# Reads every data set in a CSV export of the "SEDs" sheet in one pass, returning a spreadsheet_interface.SedCatalog
+def read_catalog(curr_file):
+    return catalog_from_rows(csv.reader(curr_file))
 
-    # Iterate until beginning of telescope list
-    i = 1
-    curr_char = curr_line[i]
-    while curr_char != ",":
-        curr_char = curr_line[i]
-        i += 1
-
-    # Populate telescope list
-    curr_char = curr_line[i]
-    while i < (len(curr_line) - (MAX_WIDTH - w)):
-        while (curr_char != ",") and (curr_char != "") and (curr_char != "\n"):
-            curr_char = curr_line[i]
-            if (curr_char != ",") and (curr_char != "") and (curr_char != "\n"):
-                curr_str += curr_char
-            i += 1
-        telescope_list.append(curr_str)
-        curr_str = ""
-        if i < len(curr_line):
-            curr_char = curr_line[i]
-    curr_line = curr_file.readline()
 
-    # Iterate until beginning of flux list
-    i = 1
-    curr_char = curr_line[i]
-    while curr_char != ",":
-        curr_char = curr_line[i]
-        i += 1
-
-    # Populate flux list
-    curr_char = curr_line[i]
-    while i < (len(curr_line) - (MAX_WIDTH - w)):
-        while (curr_char != ",") and (curr_char != "") and (curr_char != "\n"):
-            curr_char = curr_line[i]
-            if (curr_char != ",") and (curr_char != "") and (curr_char != "\n"):
-                curr_str += curr_char
-            i += 1
-        flux_list.append(float(curr_str))
-        curr_str = ""
-        if i < len(curr_line):
-            curr_char = curr_line[i]
-    curr_line = curr_file.readline()
+def catalog_from_rows(csv_rows):
+    rows = [[csv_value(cell) for cell in row] for row in csv_rows]
 
-    # Iterate until beginning of upper uncertainty list
-    i = 1
-    curr_char = curr_line[i]
-    while curr_char != ",":
-        curr_char = curr_line[i]
-        i += 1
-
-    # Populate upper uncertainty list
-    curr_char = curr_line[i]
-    while i < (len(curr_line) - (MAX_WIDTH - w)):
-        while (curr_char != ",") and (curr_char != "") and (curr_char != "\n"):
-            curr_char = curr_line[i]
-            if (curr_char != ",") and (curr_char != "") and (curr_char != "\n"):
-                curr_str += curr_char
-            i += 1
-        if ('none' in curr_str) or ('None' in curr_str):
-            unc_upper_list.append(0.0)
-        elif 'E' in curr_str:
-            to_add = scientific_to_normal(curr_str)
-            unc_upper_list.append(to_add)
-        else:
-            unc_upper_list.append(float(curr_str))
-        curr_str = ""
-        if i < len(curr_line):
-            curr_char = curr_line[i]
-    curr_line = curr_file.readline()
+    # Skip any blank lines before the first data set
+    first = 0
+    while first < len(rows) and (len(rows[first]) == 0 or rows[first][0] is None):
+        first += 1
+
+    # The catalog expects the sheet's header row before the first data set
+    return spin.SedCatalog.from_rows([()] + rows[first:], LINES_PER_DATA_SET)
 
-    # Iterate until beginning of lower uncertainty list
-    i = 1
-    curr_char = curr_line[i]
-    while curr_char != ",":
-        curr_char = curr_line[i]
-        i += 1
-
-    # Populate lower uncertainty list
-    curr_char = curr_line[i]
-    while i < (len(curr_line) - (MAX_WIDTH - w)):
-        while (curr_char != ",") and (curr_char != "") and (curr_char != "\n"):
-            curr_char = curr_line[i]
-            if (curr_char != ",") and (curr_char != "") and (curr_char != "\n"):
-                curr_str += curr_char
-            i += 1
-        if ('none' in curr_str) or ('None' in curr_str):
-            unc_lower_list.append(0.0)
-        elif 'E' in curr_str:
-            to_add = scientific_to_normal(curr_str)
-            unc_lower_list.append(to_add)
-        else:
-            unc_lower_list.append(float(curr_str))
-        curr_str = ""
-        if i < len(curr_line):
-            curr_char = curr_line[i]
-    curr_line = curr_file.readline()
 
-    # Get redshift
-    i = 1
-    curr_char = curr_line[i]
-    while curr_char != ",":
-        curr_char = curr_line[i]
-        i += 1
-    curr_char = curr_line[i]
-    curr_str = ""
-    while curr_char != ",":
-        curr_str += curr_char
-        i += 1
-        curr_char = curr_line[i]
-    if 'E' in curr_str:
-        z = scientific_to_normal(curr_str)
-    else:
-        z = float(curr_str)
+def load_catalog(location):
+    with open(location, newline="", encoding=ENCODING) as curr_file:
+        return read_catalog(curr_file)
+
+
+# Yields the galaxies of a CSV export one at a time as Galaxy classes, reading the file in a single pass and only
+# holding one data set at a time.  Galaxies can be filtered as in spreadsheet_interface.matches_filter.
+def iter_galaxies(location, names=None, z_range=None, telescopes=None):
+    if names is not None:
+        names = set(names)
+
+    with open(location, newline="", encoding=ENCODING) as curr_file:
+        block = []
+        for row in csv.reader(curr_file):
+            if len(block) == 0 and (len(row) == 0 or row[0].strip() == ""):  # Between data sets
+                continue
+            block.append(row)
+            if len(block) < LINES_PER_DATA_SET:
+                continue
+
+            if names is None or block[0][0].strip() in names:
+                g = catalog_from_rows(block).galaxy(0)
+                if spin.matches_filter(g.name, g.z, g.raw_telescopes, z_range=z_range, telescopes=telescopes):
+                    yield g
+            block = []
+
+
+# Puts data from the nth galaxy data set after the file position in a Galaxy class (returns Galaxy)
+def get_set_n(n, curr_file):  # Assumes LINES_PER_DATA_SET (constant) lines of data per galaxy
     curr_line = curr_file.readline()
 
-    # Get distance
-    i = 1
-    curr_char = curr_line[i]
-    while curr_char != ",":
-        curr_char = curr_line[i]
-        i += 1
-    curr_char = curr_line[i]
-    curr_str = ""
-    while curr_char != ",":
-        curr_str += curr_char
-        i += 1
-        curr_char = curr_line[i]
-    if 'E' in curr_str:
-        distance = scientific_to_normal(curr_str)
-    else:
-        distance = float(curr_str)
-
-    # Create galaxy and return it
-    g = galaxy.Galaxy(galaxy_name, frequency_list, telescope_list, flux_list,
-                      unc_upper_list, unc_lower_list, z, distance)
-    return g
+    # Find nth data set
+    for j in range(n):
+        for k in range(LINES_PER_DATA_SET + 1):
+            curr_line = curr_file.readline()
+
+    # Skip blank lines, then read the data set's lines
+    while curr_line != "" and curr_line.strip(", \n") == "":
+        curr_line = curr_file.readline()
+    lines = [curr_line]
+    for k in range(LINES_PER_DATA_SET - 1):
+        lines.append(curr_file.readline())
+
+    return read_catalog(lines).galaxy(0)
+
+
+# FOLLOWING: Byte-offset index
+
+class CsvIndex:
+    # Where each data set starts in a CSV export: 'offsets[n]' is the byte offset of data set n's first line, and
+    # 'index' maps each galaxy name to its data set number.  'stamp' is the (mtime_ns, size) of the CSV it describes.
+
+    def __init__(self, stamp, names, offsets):
+        self.stamp = stamp
+        self.names = names
+        self.offsets = offsets
+        self.index = {}
+        for i in range(len(names)):
+            self.index.setdefault(names[i], i)
+
+    @classmethod
+    def build(cls, location):
+        # Scans the CSV once, taking every line with something in its first column as the start of a data set
+        names = []
+        offsets = []
+        offset = 0
+        with open(location, 'rb') as f:
+            for line in f:
+                name = next(csv.reader([line.decode(ENCODING)]), [""])
+                if len(name) > 0 and name[0].strip() != "":
+                    names.append(name[0].strip())
+                    offsets.append(offset)
+                offset += len(line)
+        return cls(spin.file_stamp(location), names, np.array(offsets, dtype=np.int64))
+
+    def save(self, location):
+        arrays = {'stamp': np.array(self.stamp, dtype=np.int64), 'names': np.array(self.names, dtype=str),
+                  'offsets': self.offsets}
+        spin.atomic_save(location, lambda temp_location: np.savez(temp_location, **arrays))
+
+    @classmethod
+    def load(cls, location):
+        with np.load(location) as arrays:
+            return cls(tuple(int(value) for value in arrays['stamp']), [str(name) for name in arrays['names']],
+                       arrays['offsets'])
+
+
+_csv_indexes = {}  # CsvIndex of each CSV export used so far, by location
+
+
+def index_loc(location):
+    return os.path.splitext(location)[0] + ".csvindex.npz"
+
+
+def csv_index(location):
+    # Returns the CsvIndex of a CSV export, from memory or the index file stored next to it, building (and saving)
+    # it again only if the CSV has changed
+    stamp = spin.file_stamp(location)
+    if location in _csv_indexes and _csv_indexes[location].stamp == stamp:
+        return _csv_indexes[location]
+
+    try:
+        index = CsvIndex.load(index_loc(location))
+    except (OSError, KeyError, ValueError):
+        index = None
+    if index is None or index.stamp != stamp:
+        index = CsvIndex.build(location)
+        try:  # The index file is only a cache, so failing to write it isn't an error
+            index.save(index_loc(location))
+        except OSError:
+            pass
+
+    _csv_indexes[location] = index
+    return index
+
+
+# Puts data from the nth galaxy data set of a CSV export in a Galaxy class, reading only that data set's lines
+def get_set_at(n, location):
+    with open(location, 'rb') as f:
+        f.seek(int(csv_index(location).offsets[n]))
+        lines = [f.readline().decode(ENCODING) for k in range(LINES_PER_DATA_SET)]
+    return read_catalog(lines).galaxy(0)
+
+
+def get_set_named(galaxy_name, location):
+    return get_set_at(csv_index(location).index[galaxy_name], location)
+
+
+# FOLLOWING: CSV backend
+
+class CsvBackend:
+    # Reads the SEDs from a CSV export of the "SEDs" sheet, as a drop-in catalog source for spreadsheet_interface
+    # (see spin.WorkbookBackend for the methods every backend has).  Use as
+    #     spin.use_backend(file_read.CsvBackend(location))
+    # after which spin.catalog(), get_set_n, target_list and so on read the CSV.  CSV exports only hold the SEDs, so
+    # fits and point styles are read from and saved to fits_backend (by default, the backend in use before this one).
+    # The catalog is parsed again only when the CSV changes.
+
+    def __init__(self, location, fits_backend=None):
+        self.location = location
+        self.fits_backend = spin.backend() if fits_backend is None else fits_backend
+        self._catalog = None
+        self._stamp = None
+
+    def catalog(self):
+        stamp = spin.file_stamp(self.location)
+        if self._catalog is None or self._stamp != stamp:
+            self._catalog = load_catalog(self.location)
+            self._stamp = stamp
+        return self._catalog
+
+    def galaxy_named(self, galaxy_name):
+        # Reads only that galaxy's lines, found with the CSV's byte-offset index
+        return get_set_named(galaxy_name, self.location)
+
+    def iter_galaxies(self, names=None, z_range=None, telescopes=None):
+        return iter_galaxies(self.location, names=names, z_range=z_range, telescopes=telescopes)
+
+    def fit_rows(self, galaxy_name):
+        return self.fits_backend.fit_rows(galaxy_name)
+
+    def point_styles(self):
+        return self.fits_backend.point_styles()
+
+    def apply_fit_operations(self, operations):
+        self.fits_backend.apply_fit_operations(operations)
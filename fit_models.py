@@ -0,0 +1,227 @@
+import numpy as np
+import startup
+
+kmpfit = startup.lazy_import("kapteyn.kmpfit")  # Only needed once something is fit
+
+
+# FOLLOWING: Constants
+h = 6.626 * 10**(-34)
+k = 1.38 * 10**(-23)
+kappa_0 = .192
+nu_0 = 856.6
+
+
+# FOLLOWING: Model registry
+
+class FitModel:
+    # A model that can be fit to an SED.  function(p, freq, z, distance) evaluates the model for the full parameter
+    # list p, and jacobian(p, freq, z, distance) returns its derivative with respect to each parameter (one row per
+    # parameter).  p0 holds the default initial parameters, and seed(freq, flux, err, hold, z, distance), if given,
+    # estimates better ones for a particular data set.
+
+    def __init__(self, name, param_names, p0, function, jacobian, seed=None):
+        self.name = name
+        self.param_names = param_names
+        self.p0 = p0
+        self.function = function
+        self.jacobian = jacobian
+        self.seed = seed
+
+    def __call__(self, p, freq, z=0, distance=1):
+        return self.function(p, np.asarray(freq, dtype=float), z, distance)
+
+    def compile(self, hold, z, distance):
+        # Returns a CompiledModel for fitting only the free parameters, where parameter i is held at hold[i] if hold[i]
+        # is non-zero.
+        return CompiledModel(self, hold, z, distance)
+
+
+class CompiledModel:
+    # A model with its held parameters, redshift and distance fixed.  model(p, freq) and deriv(p, freq) take only the
+    # free parameters, and residuals/derivatives have the signatures kmpfit.Fitter expects.
+
+    def __init__(self, fit_model, hold, z, distance):
+        num_params = len(fit_model.param_names)
+        hold = (list(hold) + [0] * num_params)[:num_params]
+        fixed = np.array(hold, dtype=float)
+        free_index = np.flatnonzero(fixed == 0)
+        function = fit_model.function
+        jacobian = fit_model.jacobian
+
+        def full_params(p):
+            params = fixed.copy()
+            params[free_index] = p
+            return params
+
+        def model(p, freq):
+            return function(full_params(p), freq, z, distance)
+
+        def deriv(p, freq):
+            return jacobian(full_params(p), freq, z, distance)[free_index]
+
+        def residuals(p, data):
+            freq, flux, err = data
+            return (flux - model(p, freq)) / err
+
+        def derivatives(p, data, dflags):
+            freq, flux, err = data
+            return -deriv(p, freq) / err
+
+        self.fit_model = fit_model
+        self.hold = hold
+        self.z = z
+        self.distance = distance
+        self.free_index = free_index
+        self.p0 = [fit_model.p0[i] for i in free_index]
+        self.full_params = full_params
+        self.model = model
+        self.deriv = deriv
+        self.residuals = residuals
+        self.derivatives = derivatives
+
+
+models = {}
+
+
+def register(fit_model):
+    models[fit_model.name] = fit_model
+    return fit_model
+
+
+def evaluate(fit, freq, z, distance):
+    # Evaluates a saved fit (a row from spreadsheet_interface.read_fits) at the given frequencies
+    fit_model = models[fit[0]]
+    return fit_model(fit[1:1 + len(fit_model.param_names)], freq, z, distance)
+
+
+# FOLLOWING: Fitting
+
+def fit(model_name, freq, flux, err=None, hold=(), z=0, distance=1, p0=None):
+    # Fits a registered model to the given points using its analytic derivatives.  Returns the kmpfit Fitter (for the
+    # fit statistics) and the full list of best-fit parameters, held ones included.
+    return fit_compiled(models[model_name].compile(hold, z, distance), freq, flux, err=err, p0=p0)
+
+
+def fit_compiled(compiled, freq, flux, err=None, p0=None):
+    # Same as fit, for a model that has already been compiled
+    freq = np.asarray(freq, dtype=float)
+    flux = np.asarray(flux, dtype=float)
+    if err is None:
+        err = np.ones(len(flux))
+    else:
+        err = np.asarray(err, dtype=float)
+    if p0 is None and compiled.fit_model.seed is not None:
+        seed = compiled.fit_model.seed(freq, flux, err, compiled.hold, compiled.z, compiled.distance)
+        p0 = [seed[i] for i in compiled.free_index]
+    elif p0 is None:
+        p0 = compiled.p0
+
+    fitobj = kmpfit.Fitter(residuals=compiled.residuals, deriv=compiled.derivatives, data=(freq, flux, err),
+                           parinfo=[{'side': 3} for i in range(len(p0))])
+    fitobj.fit(params0=p0)
+    return fitobj, [float(value) for value in compiled.full_params(fitobj.params)]
+
+
+# FOLLOWING: Initial parameter grid
+
+GRID_TEMPS = np.geomspace(5, 500, 161)  # K
+GRID_BETAS = np.linspace(0, 3.5, 71)
+GRID_LOG_FREQS = np.linspace(8, 16, 1601)  # log10 Hz
+
+_planck_grid = None
+
+
+def _log_planck(freq, dust_temp):
+    # log10(1/(exp(h*freq/(k*dust_temp))-1)), without overflowing far out on the Wien side
+    x = (h*freq)/(k*dust_temp)
+    with np.errstate(over='ignore'):
+        return np.where(x > 50, -x/np.log(10), -np.log10(np.expm1(np.minimum(x, 50))))
+
+
+def planck_grid():
+    # The temperature-dependent part of the modified blackbody (see _log_planck) for every GRID_TEMPS (rows) at every
+    # GRID_LOG_FREQS (columns).  Beta only adds a power law in frequency, so together with that this gives the shape
+    # of the model for every (T, beta) cell.  Computed once, on first use.
+    global _planck_grid
+
+    if _planck_grid is None:
+        _planck_grid = _log_planck(10**GRID_LOG_FREQS[None, :], GRID_TEMPS[:, None])
+    return _planck_grid
+
+
+def mod_blackbody_seed(freq, flux, err, hold, z, distance):
+    # Returns initial [dust_temp, dust_mass, beta] for a modified blackbody fit: the (T, beta) grid cell with the
+    # lowest chi-square, where the best dust mass for each cell is solved for analytically.  Held parameters keep
+    # their values.
+    weights = 1 / err**2
+    if not np.all(np.isfinite(weights)):
+        weights = np.ones(len(flux))
+    hold = (list(hold) + [0, 0, 0])[:3]
+
+    # log10 of the model with a dust mass of 1, for every (T, beta, point)
+    if hold[0] != 0:
+        temps = np.array([hold[0]])
+        log_planck = _log_planck(freq[None, :], temps[:, None])
+    else:
+        temps = GRID_TEMPS
+        step = GRID_LOG_FREQS[1] - GRID_LOG_FREQS[0]
+        position = np.clip((np.log10(freq) - GRID_LOG_FREQS[0]) / step, 0, len(GRID_LOG_FREQS) - 1)
+        lower = np.minimum(position.astype(int), len(GRID_LOG_FREQS) - 2)
+        fraction = position - lower
+        log_planck = planck_grid()[:, lower] * (1 - fraction) + planck_grid()[:, lower + 1] * fraction
+    if hold[2] != 0:
+        betas = np.array([hold[2]])
+    else:
+        betas = GRID_BETAS
+    log_shape = (log_planck[:, None, :] + (betas[None, :, None] + 3) * np.log10((freq/(10**9))/nu_0)
+                 + np.log10(.00182917 * kappa_0 * (1 + z) / distance**2))
+    shape = 10**log_shape
+
+    # Best dust mass and chi-square in each cell
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if hold[1] != 0:
+            dust_mass = np.full(shape.shape[:2], float(hold[1]))
+        else:
+            dust_mass = np.sum(weights * flux * shape, axis=2) / np.sum(weights * shape**2, axis=2)
+            dust_mass[~(dust_mass > 0)] = np.nan
+        chi2 = np.sum(weights * (flux - dust_mass[:, :, None] * shape)**2, axis=2)
+    chi2[~np.isfinite(chi2)] = np.inf
+
+    temp_index, beta_index = np.unravel_index(np.argmin(chi2), chi2.shape)
+    if not np.isfinite(chi2[temp_index, beta_index]):
+        return [float(value) if value != 0 else p0 for value, p0 in zip(hold, models['mod_blackbody'].p0)]
+    return [float(temps[temp_index]), float(dust_mass[temp_index, beta_index]), float(betas[beta_index])]
+
+
+# FOLLOWING: Function models
+
+def mod_blackbody(p, freq, z, distance):
+    dust_temp, dust_mass, beta = p
+    snu = .00182917 * kappa_0 * (((freq/(10**9))/nu_0)**(beta+3)) * (dust_mass/(distance**2)) * (1/(np.exp((h*freq)/(k*dust_temp))-1))
+    return snu * (1 + z)
+
+
+def mod_blackbody_jacobian(p, freq, z, distance):
+    dust_temp, dust_mass, beta = p
+    snu = mod_blackbody(p, freq, z, distance)
+    x = (h*freq)/(k*dust_temp)
+    return np.array([snu * x / (dust_temp * (1 - np.exp(-x))),
+                     snu / dust_mass,
+                     snu * np.log((freq/(10**9))/nu_0)])
+
+
+def power_law(p, freq, z, distance):
+    a, alpha = p
+    snu = a*(freq**alpha)
+    return snu
+
+
+def power_law_jacobian(p, freq, z, distance):
+    a, alpha = p
+    return np.array([freq**alpha,
+                     a*(freq**alpha)*np.log(freq)])
+
+
+register(FitModel('mod_blackbody', ['dust_temp', 'dust_mass', 'beta'], [25, 10 ** 6, 1.8],
+                  mod_blackbody, mod_blackbody_jacobian, seed=mod_blackbody_seed))
+register(FitModel('power_law', ['a', 'alpha'], [0, 2], power_law, power_law_jacobian))
@@ -1,9 +1,12 @@
-import matplotlib.pyplot as plt
-from kapteyn import kmpfit
+import os
 import numpy as np
+import startup
 import spreadsheet_interface as spin
-from matplotlib.patches import Rectangle
-import gc
+import fit_models
+import monte_carlo
+
+plt = startup.lazy_import("matplotlib.pyplot")  # Only needed once something is drawn
+patches = startup.lazy_import("matplotlib.patches")
 
 # FOLLOWING: Conversion functions
 
@@ -15,345 +18,397 @@ def freq_to_wl(freq):
     return 299792458/freq
 
 
+# FOLLOWING: Model grid functions
+
+def model_grid(x_lower, x_upper, axes=None, points_per_pixel=2, model=None, tolerance=.002, max_refinements=4):
+    # Returns a log-spaced grid of frequencies on which to draw a model curve.  The number of points follows the pixel
+    # width of 'axes' (1000 points if no axes are given).  If 'model' (a function of frequency) is given, every interval
+    # where the curve bends by more than 'tolerance' (in log-log space) is split in two, up to max_refinements times.
+
+    if axes is not None:
+        num_points = int(np.clip(axes.get_window_extent().width * points_per_pixel, 200, 5000))
+    else:
+        num_points = 1000
+    grid = np.geomspace(x_lower, x_upper, num_points)
+
+    if model is None:
+        return grid
+    for i in range(max_refinements):
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            log_values = np.log10(np.abs(model(grid)))
+            log_grid = np.log10(grid)
+            slopes = np.diff(log_values) / np.diff(log_grid)
+        bends = np.abs(np.diff(slopes)) * np.diff(log_grid)[1:] > tolerance
+        split = np.zeros(len(grid) - 1, dtype=bool)
+        split[:-1] |= bends
+        split[1:] |= bends
+        if not split.any():
+            break
+        grid = np.sort(np.concatenate((grid, np.sqrt(grid[:-1][split] * grid[1:][split]))))
+
+    return grid
+
+
+# FOLLOWING: Point styles
+
+class PointStyles:
+    # Point types for different telescopes, read from spreadsheet "Point Styles".  Each telescope gets a code: its
+    # index in names/markers/colors, or -1 (the last style, named 'Other') if it isn't listed.  lookup maps each
+    # listed telescope name to its (marker, color, canonical name).
+
+    def __init__(self, telescope_names, colors, markers):
+        self.names = list(telescope_names[:-1]) + ['Other']
+        self.markers = list(markers)
+        self.colors = list(colors)
+
+        # The first row listing a telescope wins
+        self.codes = {}
+        for j in range(len(telescope_names) - 1):
+            self.codes.setdefault(telescope_names[j], j)
+        self.lookup = {}
+        for telescope, j in self.codes.items():
+            self.lookup[telescope] = (self.markers[j], self.colors[j], self.names[j])
+
+        # Code of the first style with the same marker and color as each style (the last one is 'Other')
+        style_codes = []
+        for j in range(len(self.names)):
+            first = j
+            for k in range(j):
+                if self.markers[k] == self.markers[j] and self.colors[k] == self.colors[j]:
+                    first = k
+                    break
+            style_codes.append(first)
+        self.style_codes = np.array(style_codes, dtype=np.int16)
+
+    def style(self, telescope):
+        # (marker, color, canonical name) for a telescope
+        return self.lookup.get(telescope, (self.markers[-1], self.colors[-1], 'Other'))
+
+    def codes_for(self, telescopes):
+        return np.array([self.codes.get(telescope, -1) for telescope in telescopes], dtype=np.int16)
+
+    def groups(self, codes):
+        # Splits points, given by their telescope codes, into groups drawn with the same marker and color.  Returns
+        # (marker, color, indices) for each group in order of first appearance, where indices is an index array.
+
+        point_styles = self.style_codes[codes]
+        firsts, first_points = np.unique(point_styles, return_index=True)
+        groups = []
+        for j in firsts[np.argsort(first_points)]:
+            groups.append((self.markers[j], self.colors[j], np.flatnonzero(point_styles == j)))
+        return groups
+
+
+_point_styles = None
+
+
+def point_styles():
+    # The PointStyles registry, loaded from the spreadsheet on first use
+    global _point_styles
+
+    if _point_styles is None:
+        _point_styles = PointStyles(*spin.get_point_styles())
+    return _point_styles
+
+
+# FOLLOWING: SED axes
+
+def decorate_sed_axes(axes, scaling=1):
+    # Draws the parts of an SED plot that are the same for every galaxy: log axes, axis labels and ticks, the rest
+    # wavelength axis along the top and the PAH emission boxes.  Galaxy.plot_sed draws the rest.
+
+    axes.set_yscale('log')
+    axes.set_xscale('log')
+    axes.set_xlabel('$\log$ Rest Frequency (Hz)', fontsize=10*scaling)
+    axes.set_ylabel('$\log$ Flux Density (Jy)', fontsize=10*scaling)
+
+    # Make axes
+    axes.set_yticks((10**-4, 10**-3, 10**-2, 10**-1, 10**0, 10**1, 10**2, 10**3, 10**4))
+    axes.set_yticklabels(["-4", "-3", "-2", "-1", "0", "1", "2", "3", "4"])
+    axes.set_xticks((10**10, 10**12, 10**14))
+    axes.set_xticklabels(["10", "12", "14"])
+    axes.set_aspect(1)
+    axes.tick_params(labelsize=10*scaling)
+    x_axis_wl = axes.secondary_xaxis('top', functions=(freq_to_wl, wl_to_freq))
+    x_axis_wl.tick_params(labelsize=10*scaling*.8)
+    x_axis_wl.set_xlabel("Rest Wavelength", fontsize=10*scaling)
+    x_axis_wl.get_xaxis().set_tick_params(which='minor', size=0)
+    x_axis_wl.get_xaxis().set_tick_params(which='minor', width=0)
+    x_axis_wl.set_xticks((.00000001, .0000001, .000001, .00001, .0001, .001, .01, .1))
+    labels = ['.1 \u03bcm', '1 \u03bcm', '10 \u03bcm', '100 \u03bcm', '1 mm', '1 cm', '10 cm', '1 m']
+    x_axis_wl.set_xticklabels(labels)
+
+    # Draw PAH emission reference lines as tall, thin, boxes
+    pah_freqs = [3.89*10**13, 2.65*10**13, 2.36*10**13, 4.84*10**13, 3.49*10**13]
+    for i in range(len(pah_freqs)):
+        box_width = pah_freqs[i]/10
+        left_side = pah_freqs[i] - (box_width * (np.sqrt(10))/10)
+        axes.add_patch(patches.Rectangle((left_side, 0), box_width, 100, facecolor='lightgray'))
+    return x_axis_wl
+
+
+def _float_array(values):
+    # Anything that isn't a number (e.g. a 'Limit' marker) becomes NaN
+    try:
+        return np.array(values, dtype=float)
+    except (ValueError, TypeError):
+        return np.array([value if not isinstance(value, str) else np.nan for value in values], dtype=float)
+
+
+def _limit_mask(values):
+    return np.array([isinstance(value, str) and (value == 'Limit' or value == 'limit') for value in values], dtype=bool)
+
+
 class Galaxy:
+    # Photometry is stored as NumPy arrays: freq, flux and the lower/upper uncertainties (NaN where a point is a
+    # limit), boolean masks marking upper and lower limits, and telescope_codes, the index of each point's telescope
+    # in the point_styles() registry (-1 for telescopes without a point style, which use the last style).
 
-    # Point types for different telescopes, read from spreadsheet "Point Styles"
-    type_list = spin.get_point_styles()[2]
-    color_list = spin.get_point_styles()[1]
-    telescope_name_list = spin.get_point_styles()[0]
+    __slots__ = ('name', 'freq', 'flux', 'unc_upper', 'unc_lower', 'upper_limits', 'lower_limits', 'raw_telescopes',
+                 'telescope_codes', 'z', 'distance', 'fit_without_error', 'hold')
 
-    def __init__(self, name, freq_list, telescope_list, flux_list, unc_upper_list, unc_lower_list, z, distance):
+    def __init__(self, name, freq, telescopes, flux, unc_upper, unc_lower, z, distance, upper_limits=None,
+                 lower_limits=None):
+        # The uncertainties may mark limits with 'Limit' instead of passing the limit masks.
         self.name = name
-        self.freq_list = freq_list
-        self.temp_freq_list = freq_list  # For use with exclusions
-        self.straightuptelelist = telescope_list
-        self.telescope_list = telescope_list
-        self.flux_list = flux_list
-        self.temp_flux_list = flux_list  # For use with exclusions
-        self.telescope_list, self.point_types, self.point_colors = self.make_other_lists()
-        self.error_lists = [unc_lower_list, unc_upper_list]
+        self.freq = np.asarray(freq, dtype=float)
+        self.flux = np.asarray(flux, dtype=float)
+        self.upper_limits = _limit_mask(unc_upper) if upper_limits is None else np.asarray(upper_limits, dtype=bool)
+        self.lower_limits = _limit_mask(unc_lower) if lower_limits is None else np.asarray(lower_limits, dtype=bool)
+        self.unc_upper = _float_array(unc_upper)
+        self.unc_lower = _float_array(unc_lower)
+        self.raw_telescopes = np.asarray(telescopes, dtype=object)
+        self.telescope_codes = point_styles().codes_for(self.raw_telescopes)
         self.z = z
         self.distance = distance
-        self.fit_with_error_blackbody = True
-        self.fit_with_error_powerlaw = True
+        self.fit_without_error = []  # Fit types that have already warned about falling back to no errors
         self.hold = [0, 0, 0]
-        self.holdkey = 'none'
-
-    def make_other_lists(self):
-        # This function is only for the class to call on itself.  It orders all the lists, and changes the telescope
-        # list to say 'other' if it's not included in telescope_name_list.
-
-        types = []
-        colors = []
-        ordered_tele = []
-
-        for i in range(len(self.telescope_list)):
-            switch = False
-            j = 0
-            while not switch:
-                if self.telescope_list[i] == self.telescope_name_list[j]:
-                    types.append(self.type_list[j])
-                    colors.append(self.color_list[j])
-                    ordered_tele.append(self.telescope_name_list[j])
-                    switch = True
-                elif j == (len(self.telescope_name_list) - 1):
-                    types.append(self.type_list[j])
-                    colors.append(self.color_list[j])
-                    ordered_tele.append('Other')
-                    switch = True
-                j += 1
-
-        return ordered_tele, types, colors
-
-    def clear_fits(self, fit_type):
-        # Clears saved fits of a certain type
-
-        spin.clear_fits(self.name, fit_type)
-
-    def create_fit(self, fit_range, hold=[0, 0, 0], fit_type='mod_blackbody', linestyle='solid', subtract=False):
+
+    @property
+    def telescope_list(self):
+        # Telescope of each point, or 'Other' if it doesn't have a point style
+        return np.array(point_styles().names, dtype=object)[self.telescope_codes]
+
+    @property
+    def point_types(self):
+        return np.array(point_styles().markers, dtype=object)[self.telescope_codes]
+
+    @property
+    def point_colors(self):
+        return np.array(point_styles().colors, dtype=object)[self.telescope_codes]
+
+    def fit_mask(self, fit_range):
+        # Boolean mask of the points used by a fit over fit_range (start, end, then any points to exclude)
+
+        mask = np.zeros(len(self.freq), dtype=bool)
+        mask[fit_range[0]:fit_range[1]] = True
+        mask[list(fit_range[2:])] = False
+        return mask
+
+    def clear_fits(self, fit_type, transaction=None):
+        # Clears saved fits of a certain type.  If a spreadsheet_interface transaction is given, the change is queued
+        # in it instead of being saved right away.
+
+        if transaction is None:
+            spin.clear_fits(self.name, fit_type)
+        else:
+            transaction.clear_fits(self.name, fit_type)
+
+    def create_fit(self, fit_range, hold=[0, 0, 0], fit_type='mod_blackbody', linestyle='solid', subtract=False,
+                   realizations=0, transaction=None):
         # This function creates a new fit given a range (where elements 0 and 1 are the start and end,
         # then any after are to be excluded.  Hold can be passed as a 1x3 array, where any non-zero values are
-        # parameters to be held.
-        # fit_type options: 'mod_blackbody', 'power_law'
+        # parameters to be held.  If realizations > 0, that many Monte Carlo realizations are fit to get percentiles
+        # of each parameter, which are saved with the fit.  If a spreadsheet_interface transaction is given, the fit
+        # is queued in it (so a failure later in the transaction discards it) instead of being saved right away.
+        # fit_type options: any model registered in fit_models ('mod_blackbody', 'power_law')
+
+        params, fit_range, percentiles = self.compute_fit(fit_range, hold=hold, fit_type=fit_type, subtract=subtract,
+                                                          realizations=realizations)
+        if transaction is None:
+            spin.new_fit(self.name, fit_type, params, fit_range, linestyle, percentiles=percentiles)
+        else:
+            transaction.new_fit(self.name, fit_type, params, fit_range, linestyle, percentiles=percentiles)
+
+    def compute_fit(self, fit_range, hold=[0, 0, 0], fit_type='mod_blackbody', subtract=False, verbose=True,
+                    realizations=0, jobs=None, seed=None):
+        # Does the fitting for create_fit without saving the result.  Returns the best-fit parameters, the fit range
+        # to save with them, and the parameter percentiles from the Monte Carlo realizations (None if there are none).
+        # The realizations are fit across 'jobs' worker processes (see monte_carlo.resample).
 
-        # If subtract==True, then before creating the fit, subtract out the previously created fits.
+        # If subtract==True, then fit what's left after subtracting out the previously created fits.
+        flux = self.flux
         if subtract is True:
-            for i in range(len(self.flux_list)):
-                self.flux_list[i] = self.flux_list[i] - self.sum_function(spin.read_fits(self.name), self.freq_list[i])
+            flux = self.subtract_fits(spin.read_fits(self.name))
 
         self.hold = hold
+        mask = self.fit_mask(fit_range)
 
-        self.temp_freq_list = self.freq_list.copy()
-        self.temp_flux_list = self.flux_list.copy()
-        num_exclusions = 0
-        if len(fit_range) > 2:
-            num_exclusions = len(fit_range) - 2
-            for i in range(num_exclusions):
-                self.temp_freq_list.pop(fit_range[2] - i)
-                self.temp_flux_list.pop(fit_range[2] - i)
-                fit_range.pop(2)
-                fit_range[1] -= 1
-
-        if fit_type == 'mod_blackbody':
-            dust_temp_param, dust_mass_param, beta_param = self.fit_set_mod_blackbody(fit_range[0], fit_range[1])
-            fit_range[1] += num_exclusions
-            spin.new_fit(self.name, fit_type, [dust_temp_param, dust_mass_param, beta_param], fit_range, linestyle)
-        elif fit_type == 'power_law':
-            a_param, alpha_param = self.fit_set_power_law(fit_range[0], fit_range[1])
-            fit_range[1] += num_exclusions
-            spin.new_fit(self.name, fit_type, [a_param, alpha_param], fit_range, linestyle)
+        params = self.fit_set(fit_type, mask, flux=flux, verbose=verbose)
+
+        percentiles = None
+        if realizations > 0:
+            err = self.unc_lower[mask]
+            if not np.all(np.isfinite(err) & (err > 0)):
+                raise ValueError("Monte Carlo uncertainties need a non-zero error for every fitted point")
+            samples = monte_carlo.resample(fit_type, self.freq[mask], flux[mask], err, params, hold=self.hold,
+                                           z=self.z, distance=self.distance, num_realizations=realizations,
+                                           jobs=jobs, seed=seed)
+            failed = monte_carlo.num_failed(samples)
+            if failed == len(samples):
+                raise ValueError("All " + str(failed) + " Monte Carlo realizations failed to fit")
+            if failed > 0:
+                print("WARNING: " + str(failed) + " of " + str(len(samples)) + " Monte Carlo realizations of " +
+                      self.name + " failed to fit and were left out of the percentiles.")
+            percentiles = monte_carlo.summarize(samples)
+
+        return params, [fit_range[0], fit_range[1]], percentiles
+
+    def subtract_fits(self, fit_list):
+        # Returns a copy of the fluxes with the sum of the given fits subtracted out, leaving self.flux unchanged.
+
+        return self.flux - self.sum_function(fit_list, self.freq)
 
     def display_sed(self, savefig=False, savefolder="", give_as_subplot=False, scaling=1):
         # This function just plots all the points, along with any saved fits.
 
-        # Make point list
-        pointlist = []
-        for i in range(len(self.telescope_name_list)):
-            pointlist.append(None)
+        axes = plt.gca()
+        decorate_sed_axes(axes, scaling=scaling)
+        self.plot_sed(axes, scaling=scaling)
 
-        print(self.point_types)
+        plt.tight_layout(h_pad=1.8*scaling)
+        if savefig:
+            plt.savefig(os.path.join(savefolder, "sed_" + self.name))
+            plt.clf()
+            return None
+        if give_as_subplot:
+            return plt
+        else:
+            plt.show()
 
-        # Plot each value, adding unique telescopes to point list (for legend)
-        previous_points = []
-        legend_counter = 0
+    def plot_sed(self, axes, scaling=1):
+        # Plots the points, error bars and saved fits on 'axes', and sets the title, legend and limits that go with
+        # them.  Everything else on an SED plot is drawn by decorate_sed_axes.  Returns the artists added (other than
+        # the legend, which is replaced by the next call).
+
+        freq = self.freq
+        flux = self.flux
+        telescope_list = self.telescope_list
+        artists = []
+
+        # Plot each group of points sharing a style with one call, adding the first group with each marker to the
+        # point list (for legend)
+        pointlist = []
         unique_tele_list = []
-        for i in range(len(self.freq_list)):
-            if any(ele == self.point_types[i] for ele in previous_points):
-                plt.plot(self.freq_list[i], self.flux_list[i], color=self.point_colors[i], marker=self.point_types[i], markersize=7*scaling*.7)
-            else:
-                pointlist[legend_counter], = plt.plot(self.freq_list[i], self.flux_list[i], color=self.point_colors[i],
-                                                      marker=self.point_types[i], linestyle='None', markersize=7*scaling*.7)
-                previous_points.append(self.point_types[i])
-                unique_tele_list.append(self.telescope_list[i])
-                legend_counter += 1
+        previous_points = []
+        for point_type, point_color, indices in point_styles().groups(self.telescope_codes):
+            line, = axes.plot(freq[indices], flux[indices], color=point_color, marker=point_type, linestyle='None',
+                              markersize=7*scaling*.7)
+            artists.append(line)
+            if point_type not in previous_points:
+                pointlist.append(line)
+                previous_points.append(point_type)
+                unique_tele_list.append(telescope_list[indices[0]])
 
         # Title plot, create legend, error bars, etc.
-        plt.title('SED for ' + self.name, fontsize=15*scaling)
-        plt.yscale('log')
-        plt.xscale('log')
-        plt.xlabel('$\log$ Rest Frequency (Hz)', fontsize=10*scaling)
-        plt.ylabel('$\log$ Flux Density (Jy)', fontsize=10*scaling)
-        plt.legend(pointlist, unique_tele_list, fontsize=10*scaling, bbox_to_anchor=(1, 1), loc='upper left')  # fsize 15 Put kwargs (bbox_to_anchor=(1, 1), loc='upper left') to put legend outside
-        for i in range(len(self.freq_list)):  # Plot error bars ELSE upper limits if 0 given as upper error
-            if (self.error_lists[1][i] == 'Limit') or (self.error_lists[1][i] == 'limit'):
-                plt.errorbar(self.freq_list[i], self.flux_list[i], yerr=self.flux_list[i]/5, fmt='none', ecolor='black', uplims=self.flux_list[i])
-            elif (self.error_lists[0][i] == 'Limit') or (self.error_lists[0][i] == 'limit'):
-                plt.errorbar(self.freq_list[i], self.flux_list[i], yerr=self.flux_list[i]/5, fmt='none', ecolor='black', lolims=self.flux_list[i])
-            else:
-                plt.errorbar(self.freq_list[i], self.flux_list[i], yerr=self.error_lists[0][i], fmt='none', ecolor='black')
-        x_lower = np.min(self.freq_list)/2
+        axes.set_title('SED for ' + self.name, fontsize=15*scaling)
+        axes.legend(pointlist, unique_tele_list, fontsize=10*scaling, bbox_to_anchor=(1, 1), loc='upper left')  # fsize 15 Put kwargs (bbox_to_anchor=(1, 1), loc='upper left') to put legend outside
+
+        # Plot error bars ELSE upper limits if 'Limit' given as upper error (lower limits if given as lower error)
+        upper_limits = self.upper_limits
+        lower_limits = self.lower_limits & ~upper_limits
+        with_errors = ~(upper_limits | lower_limits)
+        if upper_limits.any():
+            artists.append(axes.errorbar(freq[upper_limits], flux[upper_limits], yerr=flux[upper_limits]/5,
+                                         fmt='none', ecolor='black', uplims=True))
+        if lower_limits.any():
+            artists.append(axes.errorbar(freq[lower_limits], flux[lower_limits], yerr=flux[lower_limits]/5,
+                                         fmt='none', ecolor='black', lolims=True))
+        if with_errors.any():
+            artists.append(axes.errorbar(freq[with_errors], flux[with_errors], yerr=self.unc_lower[with_errors],
+                                         fmt='none', ecolor='black'))
+        x_lower = np.min(freq)/2
         x_upper = 2*10**14
-        y_lower = np.min(self.flux_list)/2
-        y_upper = np.max(self.flux_list)*1.5
+        y_lower = np.min(self.flux)/2
+        y_upper = np.max(self.flux)*1.5
 
         # Plot all the fits from the parameters in the spreadsheet
         fit_list = spin.read_fits(self.name)
         if fit_list != []:
             for i in range(len(fit_list)):
                 if fit_list[i][0] == 'mod_blackbody':
-                    xrange = np.arange(x_lower, 10**14, 1000000000)
-                    fitplot = self.mod_blackbody_model([fit_list[i][1],
-                                                        fit_list[i][2],
-                                                        fit_list[i][3]], xrange)
+                    params = [fit_list[i][1], fit_list[i][2], fit_list[i][3]]
+                    xrange = model_grid(x_lower, 10**14, axes=axes,
+                                        model=lambda freq: self.mod_blackbody_model(params, freq))
+                    fitplot = self.mod_blackbody_model(params, xrange)
                 elif fit_list[i][0] == 'power_law':
-                    xrange = np.arange(10**11, 3*10**14, 1000000000)
+                    xrange = model_grid(10**11, 3*10**14, axes=axes)
                     fitplot = self.power_law_model([fit_list[i][1], fit_list[i][2]], xrange)
-                plt.plot(xrange, fitplot, color='black', linestyle=fit_list[i][6])
+                artists += axes.plot(xrange, fitplot, color='black', linestyle=fit_list[i][6])
 
         # Plot the sum of all fits
         if fit_list != []:
-            xrange = np.arange(x_lower, x_upper, 1000000000)
+            xrange = model_grid(x_lower, x_upper, axes=axes, model=lambda freq: self.sum_function(fit_list, freq))
             fitplot = self.sum_function(fit_list, xrange)
-            plt.plot(xrange, fitplot, color='black', linestyle='solid', alpha=.5)
+            artists += axes.plot(xrange, fitplot, color='black', linestyle='solid', alpha=.5)
 
-        # Make axes
-        axes = plt.gca()
-        axes.set_yticks((10**-4, 10**-3, 10**-2, 10**-1, 10**0, 10**1, 10**2, 10**3, 10**4))
-        axes.set_yticklabels(["-4", "-3", "-2", "-1", "0", "1", "2", "3", "4"])
-        axes.set_xlim(x_lower, x_upper)
-        axes.set_xticks((10**10, 10**12, 10**14))
-        axes.set_xticklabels(["10", "12", "14"])
-        axes.set_aspect(1)
-        axes.tick_params(labelsize=10*scaling)
-        x_axis_wl = axes.secondary_xaxis('top', functions=(freq_to_wl, wl_to_freq))
-        x_axis_wl.tick_params(labelsize=10*scaling*.8)
-        x_axis_wl.set_xlabel("Rest Wavelength", fontsize=10*scaling)
-        x_axis_wl.get_xaxis().set_tick_params(which='minor', size=0)
-        x_axis_wl.get_xaxis().set_tick_params(which='minor', width=0)
+        axes.set_xlim(min(x_lower, 10**10), x_upper)  # Always keeping the 10^10 Hz tick in view
         axes.set_ylim(y_lower, y_upper)
-        x_axis_wl.set_xticks((.00000001, .0000001, .000001, .00001, .0001, .001, .01, .1))
-        labels = ['.1 \u03bcm', '1 \u03bcm', '10 \u03bcm', '100 \u03bcm', '1 mm', '1 cm', '10 cm', '1 m']
-        x_axis_wl.set_xticklabels(labels)
-
-        # Draw PAH emission reference lines as tall, thin, boxes
-        pah_freqs = [3.89*10**13, 2.65*10**13, 2.36*10**13, 4.84*10**13, 3.49*10**13]
-        for i in range(len(pah_freqs)):
-            box_width = pah_freqs[i]/10
-            left_side = pah_freqs[i] - (box_width * (np.sqrt(10))/10)
-            axes.add_patch(Rectangle((left_side, 0), box_width, 100, facecolor='lightgray'))
-
-        plt.tight_layout(h_pad=1.8*scaling)
-        if savefig:
-            plt.savefig(savefolder + "\\sed_" + self.name)
-            plt.clf()
-            return None
-        if give_as_subplot:
-            return plt
-        else:
-            plt.show()
+        return artists
 
     # FOLLOWING: Chi-square fitting functions
 
-    def fit_set_mod_blackbody(self, start_index, end_index):
-        # This function uses mod_blackbody_model to find the chi-square best fit parameters for a given range.
-
-        freq_to_fit = self.temp_freq_list[start_index:end_index]
-        flux_to_fit = self.temp_flux_list[start_index:end_index]
-        p1hold = 0
-        p2hold = 0
-        p3hold = 0
-
-        # If some parameters are held, modify initial parameters accordingly
-        p0 = [25, 10 ** 6, 1.8]
-        if self.hold[0] != 0:
-            p1hold = self.hold[0]
-            self.holdkey = 'dust_temp'
-            del p0[0]
-        if self.hold[1] != 0:
-            p2hold = self.hold[1]
-            if self.holdkey == 'none':
-                self.holdkey = 'dust_mass'
-                del p0[1]
-            else:
-                self.holdkey = self.holdkey + ', dust_mass'
-                del p0[0]
-        if self.hold[2] != 0:
-            p3hold = self.hold[2]
-            if self.holdkey == 'none':
-                self.holdkey = 'beta'
-                del p0[2]
-            else:
-                self.holdkey = self.holdkey + ', beta'
-                del p0[1]
-
-        try:
-            fitobj = kmpfit.simplefit(self.mod_blackbody_model, p0, freq_to_fit, flux_to_fit,
-                                      err=self.error_lists[0][start_index:end_index])
-        except:
-            if self.fit_with_error_blackbody:
+    def fit_set(self, fit_type, mask, flux=None, verbose=True):
+        # This function uses the model registered as fit_type to find the chi-square best fit parameters for the points
+        # selected by mask (see fit_mask), holding any parameters given a non-zero value in self.hold.  flux defaults to
+        # self.flux.
+
+        if flux is None:
+            flux = self.flux
+        freq_to_fit = self.freq[mask]
+        flux_to_fit = flux[mask]
+        err = self.unc_lower[mask]
+
+        # Limits and zero errors can't be weighted, so those fits fall back to no errors
+        if np.all(np.isfinite(err) & (err > 0)):
+            fitobj, params = fit_models.fit(fit_type, freq_to_fit, flux_to_fit, err=err, hold=self.hold,
+                                            z=self.z, distance=self.distance)
+        else:
+            if fit_type not in self.fit_without_error:
                 print("WARNING: Could not fit with error.")
-                self.fit_with_error_blackbody = False
-            fitobj = kmpfit.simplefit(self.mod_blackbody_model, p0, freq_to_fit, flux_to_fit)
+                self.fit_without_error.append(fit_type)
+            fitobj, params = fit_models.fit(fit_type, freq_to_fit, flux_to_fit, hold=self.hold,
+                                            z=self.z, distance=self.distance)
 
         # Print fit parameters
-        print("\nFit status kmpfit:")
-        print("====================")
-        print("Best-fit parameters:        ", fitobj.params)
-        print("Asymptotic error:           ", fitobj.xerror)
-        print("Error assuming red.chi^2=1: ", fitobj.stderr)
-        print("Chi^2 min:                  ", fitobj.chi2_min)
-        print("Reduced Chi^2:              ", fitobj.rchi2_min)
-        print("Iterations:                 ", fitobj.niter)
-        print("Number of free pars.:       ", fitobj.nfree)
-        print("Degrees of freedom:         ", fitobj.dof)
-
-        # Set parameters to return depending on held parameters
-        counter = 0
-        return_params = [0]
-        if self.hold[0] != 0:
-            return_params[0] = p1hold
-        else:
-            return_params[0] = fitobj.params[counter]
-            counter += 1
-        if self.hold[1] != 0:
-            return_params.append(p2hold)
-        else:
-            return_params.append(fitobj.params[counter])
-            counter += 1
-        if self.hold[2] != 0:
-            return_params.append(p3hold)
-        else:
-            return_params.append(fitobj.params[counter])
-
-        return return_params
-
-    def fit_set_power_law(self, start_index, end_index):
-        # This function uses a power_law to find the chi-square best fit parameters for a given range.
-
-        freq_to_fit = self.temp_freq_list[start_index:end_index]
-        flux_to_fit = self.temp_flux_list[start_index:end_index]
-        p0 = (0, 2)
-
-        try:
-            fitobj = kmpfit.simplefit(self.power_law_model, p0, freq_to_fit, flux_to_fit,
-                                      err=self.error_lists[0][start_index:end_index])
-        except:
-            if self.fit_with_error_powerlaw:
-                print("WARNING: Could not fit with error.")
-                self.fit_with_error_powerlaw = False
-            fitobj = kmpfit.simplefit(self.power_law_model, p0, freq_to_fit, flux_to_fit)
-        return fitobj.params
+        if verbose:
+            print("\nFit status kmpfit:")
+            print("====================")
+            print("Best-fit parameters:        ", fitobj.params)
+            print("Asymptotic error:           ", fitobj.xerror)
+            print("Error assuming red.chi^2=1: ", fitobj.stderr)
+            print("Chi^2 min:                  ", fitobj.chi2_min)
+            print("Reduced Chi^2:              ", fitobj.rchi2_min)
+            print("Iterations:                 ", fitobj.niter)
+            print("Number of free pars.:       ", fitobj.nfree)
+            print("Degrees of freedom:         ", fitobj.dof)
+
+        return params
 
     # FOLLOWING: Function models
 
     def mod_blackbody_model(self, p, freq):
-        # Constants for use in model
-        h = 6.626 * 10**(-34)
-        k = 1.38 * 10**(-23)
-        kappa_0 = .192
-        nu_0 = 856.6
-
-        # Determines if different parameters are to be held constant in the fitting
-        dust_temp = 0
-        dust_mass = 0
-        beta = 0
-        if len(p) == 3:
-            dust_temp, dust_mass, beta = p
-        elif len(p) == 2:
-            if self.holdkey == 'beta':
-                dust_temp, dust_mass = p
-                beta = self.hold[2]
-            elif self.holdkey == 'dust_mass':
-                dust_temp, beta = p
-                dust_mass = self.hold[1]
-            elif self.holdkey == 'dust_temp':
-                dust_mass, beta = p
-                dust_temp = self.hold[0]
-        else:
-            if self.holdkey == 'dust_mass, beta':
-                dust_temp = p
-                beta = self.hold[2]
-                dust_mass = self.hold[1]
-            elif self.holdkey == 'dust_temp, beta':
-                dust_mass = p
-                dust_temp = self.hold[0]
-                beta = self.hold[2]
-            elif self.holdkey == 'dust_temp, dust_mass':
-                beta = p
-                dust_temp = self.hold[0]
-                dust_mass = self.hold[1]
-
-        snu = .00182917 * kappa_0 * (((freq/(10**9))/nu_0)**(beta+3)) * (dust_mass/(self.distance**2)) * (1/(np.exp((h*freq)/(k*dust_temp))-1))
-        return snu * (1 + self.z)
+        return fit_models.models['mod_blackbody'](p, freq, self.z, self.distance)
 
     def power_law_model(self, p, freq):
-        a, alpha = p
-        snu = a*(freq**alpha)
-        return snu
+        return fit_models.models['power_law'](p, freq, self.z, self.distance)
 
     def sum_function(self, fit_list, freq):
         # Takes an array 'fit_list' that is a list of all the saved fits.  Returns the sum of all these.
 
-        sum_list = []
-
-        for i in range(len(fit_list)):
-            if fit_list[i][0] == 'mod_blackbody':
-                sum_list.append(self.mod_blackbody_model([fit_list[i][1], fit_list[i][2], fit_list[i][3]], freq))
-            elif fit_list[i][0] == 'power_law':
-                sum_list.append(self.power_law_model([fit_list[i][1], fit_list[i][2]], freq))
-
         sum_func = 0
-        for i in range(len(sum_list)):
-            sum_func += sum_list[i]
+        for i in range(len(fit_list)):
+            if fit_list[i][0] in fit_models.models:
+                sum_func = sum_func + fit_models.evaluate(fit_list[i], freq, self.z, self.distance)
 
         return sum_func
@@ -0,0 +1,112 @@
+import numpy as np
+import startup
+import spreadsheet_interface as spin
+import galaxy
+import fit_models
+
+plt = startup.lazy_import("matplotlib.pyplot")
+
+
+# FOLLOWING: Constants
+ROWS = 3
+COLS = 7
+X_LIMITS = (5e8, 4e14)
+Y_LIMITS = (2*10**-4, 2000)
+POINT_STYLES = [  # (telescope, color, marker, markersize) of the points drawn on each panel, None for any other
+    ("ALMA (Nuclear)", "rebeccapurple", "v", 4),
+    ("ALMA (Extended)", "rebeccapurple", "^", 5),
+    (None, "peru", "+", 4)
+]
+
+
+# FOLLOWING: Data
+
+def panel_data(names):
+    # Returns (Galaxy, saved fits as in spin.read_fits) for each named galaxy, all from one read of the catalog
+    c = spin.catalog()
+    panels = []
+    for name in names:
+        panels.append((c.galaxy_named(name), spin.read_fits(name)))
+    return panels
+
+
+def pages(names, rows=ROWS, cols=COLS):
+    # Splits names into pages of rows*cols panels
+    per_page = rows * cols
+    return [names[i:i + per_page] for i in range(0, len(names), per_page)]
+
+
+def page_location(save_location, page, num_pages):
+    # Save location of one page, numbered from 1 if there's more than one
+    if num_pages == 1:
+        return save_location
+    return save_location + "_page" + str(page + 1)
+
+
+# FOLLOWING: Drawing
+
+def draw_panel(axes, g, fit_list):
+    # Draws one galaxy's points (one plot call per style) and saved fits on a panel
+    other = np.ones(len(g.freq), dtype=bool)
+    for telescope, color, marker, markersize in POINT_STYLES:
+        if telescope is None:
+            points = other
+        else:
+            points = g.raw_telescopes == telescope
+            other &= ~points
+        if points.any():
+            axes.plot(g.freq[points], g.flux[points], linestyle="None", color=color, marker=marker,
+                      markersize=markersize)
+
+    if fit_list:
+        xrange = galaxy.model_grid(X_LIMITS[0], X_LIMITS[1], axes=axes)
+        for fit in fit_list:
+            if fit[0] in fit_models.models:
+                axes.plot(xrange, fit_models.evaluate(fit, xrange, g.z, g.distance), color='black',
+                          linestyle=fit[6])
+
+
+def draw_page(panels, rows=ROWS, cols=COLS, bold=()):
+    # Draws a page of panels (see panel_data) on a rows x cols grid, filling each row from the left.  Panels of
+    # galaxies named in 'bold' are drawn with thick spines.  Returns the figure.
+    layout_dict = {
+        "w_pad": 1,
+        "h_pad": 30
+    }
+    fig, axs = plt.subplots(rows, cols, sharex=True, sharey=True, tight_layout=layout_dict, figsize=(11, 5),
+                            squeeze=False)
+    for i in range(rows * cols):
+        axes = axs[i // cols, i % cols]
+        if i >= len(panels):  # Fewer targets than subplots
+            axes.axis('off')
+            continue
+        g, fit_list = panels[i]
+        draw_panel(axes, g, fit_list)
+        axes.set_yscale('log')
+        axes.set_xscale('log')
+        axes.set_xlim(*X_LIMITS)
+        axes.set_ylim(*Y_LIMITS)
+        axes.tick_params(which="both", axis="y", direction="in", pad=5, labelsize=7)
+        axes.tick_params(which="both", axis="x", direction="in", labelsize=7)
+        axes.set_title("   " + g.name, fontdict={"fontsize": 6}, loc="left", y=.8)
+        axes.minorticks_off()
+        axes.set_yticks((10**-2, 1, 10**2))
+        axes.set_yticklabels([-2, 0, 2])
+        axes.set_xticks((10 ** 10, 10 ** 13))
+        axes.set_xticklabels([10, 13])
+        if g.name in bold:
+            for axis in ['top', 'bottom', 'left', 'right']:
+                axes.spines[axis].set_linewidth(3)
+
+    plt.subplots_adjust(bottom=.15, hspace=0, wspace=0, right=.8)
+    axs[rows - 1, cols // 2].set_xlabel("log$_{10}$ Rest Frequency (Hz)")
+    axs[rows // 2, 0].set_ylabel("log$_{10}$ Flux Density (Jy)")
+    return fig
+
+
+def save_page(names, save_location, rows=ROWS, cols=COLS, bold=()):
+    # Draws and saves one page, then closes it.  Returns save_location.
+    fig = draw_page(panel_data(names), rows=rows, cols=cols, bold=bold)
+    fig.savefig(save_location, dpi=500)
+    plt.close(fig)
+    return save_location
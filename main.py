@@ -1,110 +1,121 @@
-import galaxy
-import spreadsheet_interface as spin
-import numpy as np
-import matplotlib.pyplot as plt
-import gc
-from astropy.io import fits
-from mpl_toolkits.axes_grid1 import make_axes_locatable
+import startup
+import argparse
+
+# Heavy modules (and, through spreadsheet_interface, the workbook) are only loaded once a menu action uses them
+spin = startup.lazy_import("spreadsheet_interface")
+batch = startup.lazy_import("batch")
+plt = startup.lazy_import("matplotlib.pyplot")
+alma_panel = startup.lazy_import("alma_panel")
+grid_plot = startup.lazy_import("grid_plot")
+file_read = startup.lazy_import("file_read")
+sqlite_backend = startup.lazy_import("sqlite_backend")
 
 
 # FOLLOWING: Constants
 spreadsheet_loc = r"C:\Users\bderi\Box\School\Research Boizelle\ALMA Archive Galaxy Observations with SED Flux Densities"
 fits_loc = r"C:\Users\bderi\Box\School\Research Boizelle\FITS"
+sed_folder = r"C:\Users\bderi\Desktop\Research Boizelle\AutoSED"  # Where print_all_seds saves each SED
+grid_folder = r"C:\Users\bderi\Desktop"  # Where print_set_of_seds saves its grid
+alma_folder = r"C:\Users\bderi\Desktop\ALMA Images with SEDs"  # Where sed_w_alma saves its panels
 
 # FOLLOWING: Menu functions
 
-def indiv_target_menu(target, exit_check):
-    # Check for condition to exit loop
-    if exit_check:
-        return None
+def indiv_target_menu(target):
+    # Loops until the user returns to the main menu
+    while True:
+        print("\nSelect action for " + target.name + ":")
+        print("\t0: Display SED\n",
+              "\t1: Create new fit\n",
+              "\t2: Clear saved fits\n",
+              "\t3: List saved fits\n",
+              "\t4: Return to main menu\n")
+        selection = input("Enter selection:")
 
-    print("\nSelect action for " + target.name + ":")
-    print("\t0: Display SED\n",
-          "\t1: Create new fit\n",
-          "\t2: Clear saved fits\n",
-          "\t3: List saved fits\n",
-          "\t4: Return to main menu\n")
-    selection = input("Enter selection:")
+        if selection == '0':  # Display SED
+            print("\nDisplaying SED for " + target.name + " . . . ")
+            target.display_sed()
 
-    if selection == '0':  # Display SED
-        print("\nDisplaying SED for " + target.name + " . . . ")
-        target.display_sed()
-        indiv_target_menu(target, False)
-
-    elif selection == '1':  # Create new fit
-        hold = [0, 0, 0]
-        linestyle = 'solid'
-        fit_type = 'mod_blackbody'
-        print("\nSelect fit type:\n",
-              "\t0: Modified blackbody\n",
-              "\t1: Power law\n")
-        selection = input("Enter selection:")
-        if selection == '0':
+        elif selection == '1':  # Create new fit
+            hold = [0, 0, 0]
+            linestyle = 'solid'
             fit_type = 'mod_blackbody'
-        elif selection == '1':
-            fit_type = 'power_law'
-        else:
-            print("Invalid input -- try again . . . ")
-            indiv_target_menu(target, False)
-        selection = input("Enter range start, end, then exclusions as a comma separated list:")
-        selection = selection.split(',')
-        for i in range(len(selection)):
-            selection[i] = int(selection[i])
-        fit_range = selection
-        if fit_type == 'mod_blackbody':
-            selection = input("Enter hold values as a comma separated list if applicable:")
+            print("\nSelect fit type:\n",
+                  "\t0: Modified blackbody\n",
+                  "\t1: Power law\n")
+            selection = input("Enter selection:")
+            if selection == '0':
+                fit_type = 'mod_blackbody'
+            elif selection == '1':
+                fit_type = 'power_law'
+            else:
+                print("Invalid input -- try again . . . ")
+                continue
+            selection = input("Enter range start, end, then exclusions as a comma separated list:")
+            selection = selection.split(',')
+            for i in range(len(selection)):
+                selection[i] = int(selection[i])
+            fit_range = selection
+            if fit_type == 'mod_blackbody':
+                selection = input("Enter hold values as a comma separated list if applicable:")
+                if selection != "":
+                    selection = selection.split(',')
+                    for i in range(len(selection)):
+                        selection[i] = float(selection[i])
+                    hold = selection
+            selection = input("Enter linestyle if applicable (see matplotlib docs for options):")
             if selection != "":
-                selection = selection.split(',')
-                for i in range(len(selection)):
-                    selection[i] = float(selection[i])
-                hold = selection
-        selection = input("Enter linestyle if applicable (see matplotlib docs for options):")
-        if selection != "":
-            linestyle = selection
-        print("Subtract out background levels for this fit?\n",
-              "\t0: Yes\n",
-              "\t1: No")
-        selection = input("Enter selection:")
-        subtract = False
-        if selection == '0':
-            subtract = True
-        try:
-            target.create_fit(fit_range, hold=hold, fit_type=fit_type, linestyle=linestyle, subtract=subtract)
-        except:
-            print("\n**Could not create fit because of invalid input**")
-        indiv_target_menu(target, False)
-
-    elif selection == '2':  # Clear fits
-        print("Which fits would you like to clear?:\n",
-              "\t0: Modified Blackbody\n",
-              "\t1: Power law\n")
-        selection = input("Enter selection:")
-        if selection == '0':
-            target.clear_fits('mod_blackbody')
-        elif selection == '1':
-            target.clear_fits('power_law')
-        else:
+                linestyle = selection
+            print("Subtract out background levels for this fit?\n",
+                  "\t0: Yes\n",
+                  "\t1: No")
+            selection = input("Enter selection:")
+            subtract = False
+            if selection == '0':
+                subtract = True
+            selection = input("Enter number of Monte Carlo realizations for parameter uncertainties if applicable:")
+            realizations = 0
+            if selection != "":
+                realizations = int(selection)
+            try:
+                target.create_fit(fit_range, hold=hold, fit_type=fit_type, linestyle=linestyle, subtract=subtract,
+                                  realizations=realizations)
+            except:
+                print("\n**Could not create fit because of invalid input**")
+
+        elif selection == '2':  # Clear fits
+            print("Which fits would you like to clear?:\n",
+                  "\t0: Modified Blackbody\n",
+                  "\t1: Power law\n")
+            selection = input("Enter selection:")
+            if selection == '0':
+                target.clear_fits('mod_blackbody')
+            elif selection == '1':
+                target.clear_fits('power_law')
+            else:
+                print("Invalid input -- try again . . . ")
+
+        elif selection == '3':  # List saved fits
+            print_saved_fits(target.name)
+
+        elif selection == '4':  # Return to main menu
+            return None
+
+        else:  # Any other invalid input
             print("Invalid input -- try again . . . ")
-            indiv_target_menu(target, False)
-        indiv_target_menu(target, False)
 
-    elif selection == '3':  # List saved fits
-        print("Saved fits for " + target.name + ":")
-        fit_list = spin.read_fits(target.name)
-        for i in range(len(fit_list)):
-            print(str(i) + ":")
-            print("\tType:", fit_list[i][0], "\n",
-                  "\tParameters:", fit_list[i][1:4], "\n",
-                  "\tRange:", fit_list[i][4:6], "\n",
-                  "\tLinestyle:", fit_list[i][6])
-        indiv_target_menu(target, False)
 
-    elif selection == '4':  # Return to main menu
-        indiv_target_menu(target, True)
-
-    else:  # Any other invalid input
-        print("Invalid input -- try again . . . ")
-        indiv_target_menu(target, False)
+def print_saved_fits(galaxy_name):
+    print("Saved fits for " + galaxy_name + ":")
+    fit_list = spin.read_fits(galaxy_name)
+    percentile_list = spin.read_fit_percentiles(galaxy_name)
+    for i in range(len(fit_list)):
+        print(str(i) + ":")
+        print("\tType:", fit_list[i][0], "\n",
+              "\tParameters:", fit_list[i][1:4], "\n",
+              "\tRange:", fit_list[i][4:6], "\n",
+              "\tLinestyle:", fit_list[i][6])
+        if percentile_list[i] is not None:
+            print("\tPercentiles (" + ", ".join(spin.PERCENTILE_LABELS) + "):", percentile_list[i])
 
 
 def select_target_menu():
@@ -119,24 +130,16 @@ def select_target_menu():
         return None
     else:
         g = spin.get_set_n(selection)
-    indiv_target_menu(g, False)
+    indiv_target_menu(g)
 
 
-def print_all_seds():
-    save_folder = r"C:\Users\bderi\Desktop\Research Boizelle\AutoSED"
-    name_list = spin.target_list()
-    for i in range(len(name_list)):
-        try:
-            g = spin.get_set_n(i)
-            g.display_sed(savefig=True, savefolder=save_folder)
-            del g
-            gc.collect()
-        except:
-            pass
+def print_all_seds(jobs=None):
+    results = batch.render_seds(sed_folder, jobs=jobs)
+    batch.print_report(results)
+    return results
 
 
 def print_set_of_seds():
-    save_folder = r"C:\Users\bderi\Desktop"
     print("\nSelect targets for which to print SEDs:")
     name_list = spin.target_list()
     for i in range(len(name_list)):
@@ -144,79 +147,26 @@ def print_set_of_seds():
     selections = input("Enter selection:")
     selections = selections.split(",")
     for i in range(len(selections)):
-        selections[i] = int(selections[i])
-    xplots = 3
-    yplots = 7
-    layout_dict = {
-        "w_pad": 1,
-        "h_pad": 30
-    }
-    fig, axs = plt.subplots(xplots, yplots, sharex=True, sharey=True, tight_layout=layout_dict, figsize=(11, 5))
-    selection_iter = 0
-    for h in range(xplots):
-        for k in range(yplots):
-            g = spin.get_set_n(selections[selection_iter])
-            for i in range(len(g.freq_list)):
-                if g.straightuptelelist[i] == "ALMA (Nuclear)":
-                    axs[h, k].plot(g.freq_list[i], g.flux_list[i], linestyle="None",
-                                                    color="rebeccapurple",
-                                                    marker="v",
-                                                    markersize=4)
-                elif g.straightuptelelist[i] == "ALMA (Extended)":
-                    axs[h, k].plot(g.freq_list[i], g.flux_list[i], linestyle="None",
-                                                    color="rebeccapurple",
-                                                    marker="^",
-                                                    markersize=5)
-                else:  # unique point
-                    axs[h, k].plot(g.freq_list[i], g.flux_list[i], linestyle="None",
-                                   color="peru",
-                                   marker="+",
-                                   markersize=4)
-            axs[h, k].set_yscale('log')
-            axs[h, k].set_xscale('log')
-            axs[h, k].set_xlim(5e8, 4e14)
-            axs[h, k].set_ylim(2*10**-4, 2000)
-            axs[h, k].tick_params(which="both", axis="y", direction="in", pad=5, labelsize=7)
-            axs[h, k].tick_params(which="both", axis="x", direction="in", labelsize=7)
-            axs[h, k].set_title("   " + g.name, fontdict={"fontsize": 6}, loc="left", y=.8)
-            axs[h, k].minorticks_off()
-            axs[h, k].set_yticks((10**-2, 1, 10**2))
-            axs[h, k].set_yticklabels([-2, 0, 2])
-            axs[h, k].set_xticks((10 ** 10, 10 ** 13))
-            axs[h, k].set_xticklabels([10, 13])
-            if ([h, k] == [0, 0]) or ([h, k] == [0, 1]) or ([h, k] == [0, 2]) or ([h, k] == [0, 3]) or \
-                    ([h, k] == [0, 4]) or ([h, k] == [0, 5]) or ([h, k] == [0, 6]) or ([h, k] == [1, 0]) or \
-                    ([h, k] == [1, 1]) or ([h, k] == [1, 2]) or ([h, k] == [1, 3]) or ([h, k] == [1, 4]) or \
-                    ([h, k] == [1, 5]):
-                for axis in ['top', 'bottom', 'left', 'right']:
-                    axs[h, k].spines[axis].set_linewidth(3)
-
-            fit_list = spin.read_fits(g.name)
-            if fit_list != []:
-                for i in range(len(fit_list)):
-                    if fit_list[i][0] == 'mod_blackbody':
-                        xrange = np.arange(5e8, 4e14, 100000000000)
-                        fitplot = g.mod_blackbody_model([fit_list[i][1],
-                                                            fit_list[i][2],
-                                                            fit_list[i][3]], xrange)
-                    elif fit_list[i][0] == 'power_law':
-                        xrange = np.arange(5e8, 4e14, 100000000000)
-                        fitplot = g.power_law_model([fit_list[i][1], fit_list[i][2]], xrange)
-                    axs[h, k].plot(xrange, fitplot, color='black', linestyle=fit_list[i][6])
-            selection_iter += 1
-    plt.subplots_adjust(bottom=.15, hspace=0, wspace=0, right=.8)
-    axs[2, 3].set_xlabel("log$_{10}$ Rest Frequency (Hz)")
-    axs[1, 0].set_ylabel("log$_{10}$ Flux Density (Jy)")
-    plt.savefig(save_folder + "\\all_seds_w_alma", dpi=500)
+        selections[i] = name_list[int(selections[i])]
+    sed_grid(selections, grid_folder + "\\all_seds_w_alma", bold=selections[:13])  # First 13 panels in bold
+    return None
+
+
+def sed_grid(names, save_location, show=True, rows=3, cols=7, bold=(), jobs=None):
+    # Plots the SEDs of the named galaxies on pages of rows x cols subplots and saves them (see grid_plot).  If the
+    # pages aren't shown, they're drawn in 'jobs' worker processes.
+    if not show:
+        return batch.render_sed_grid(names, save_location, rows=rows, cols=cols, bold=bold, jobs=jobs)
+
+    name_pages = grid_plot.pages(list(names), rows=rows, cols=cols)
+    for i in range(len(name_pages)):
+        fig = grid_plot.draw_page(grid_plot.panel_data(name_pages[i]), rows=rows, cols=cols, bold=bold)
+        fig.savefig(grid_plot.page_location(save_location, i, len(name_pages)), dpi=500)
     plt.show()
     return None
 
-def sed_w_alma():
-    save_folder = r"C:\Users\bderi\Desktop\ALMA Images with SEDs"
-    asec_spacing = 6
-    ext_flux_spacing = .0002
-    nuc_flux_spacing = .005
 
+def sed_w_alma():
     # Get user input for which target to display
     print("\nSelect target to work with:")
     name_list = spin.target_list()
@@ -229,97 +179,274 @@ def sed_w_alma():
         return None
     else:
         g = spin.get_set_n(selection)
+    sed_alma_panel(g, alma_folder)
 
-    # Put SED on the top
-    fig, axs = plt.subplots(2, 3)
-    axs[0, 0] = plt.subplot2grid((3, 2), (0, 0), colspan=3)
-    axs[0, 0] = g.display_sed(give_as_subplot=True, scaling=.7)
-
-    # Put the images on the bottom
-    file1_name = fits_loc + "\\" + g.name.replace(" ", "") + r"ALMANuclearNat.fits"
-    cont_map = fits.open(file1_name)
-    try:
-        file2_name = fits_loc + "\\" + g.name.replace(" ", "") + r"ALMAExtendedLowerNat.fits"
-        file3_name = fits_loc + "\\" + g.name.replace(" ", "") + r"ALMAExtendedUpperNat.fits"
-        lower_sub_map = fits.open(file2_name)
-        upper_sub_map = fits.open(file3_name)
-    except:
-        file2_name = fits_loc + "\\" + g.name.replace(" ", "") + r"ALMAExtendedNoiseNat.fits"
-        file3_name = file2_name
-        lower_sub_map = fits.open(file2_name)
-        upper_sub_map = fits.open(file3_name)
-
-    colormap = "pink"
-
-    image_size = np.round((3600 * (cont_map[0].header['CDELT2'] * len(cont_map[0].data[0][0]))), 2)  # In arc seconds
-    firstfig = axs[1, 0].imshow(cont_map[0].data[0][0], cmap=colormap,
-                             extent=(image_size / 2, -image_size / 2, -image_size / 2, image_size / 2))
-    secondfig = axs[1, 1].imshow(lower_sub_map[0].data[0][0], cmap=colormap,
-                              extent=(image_size / 2, -image_size / 2, -image_size / 2, image_size / 2))
-    thirdfig = axs[1, 2].imshow(upper_sub_map[0].data[0][0], cmap=colormap,
-                             extent=(image_size / 2, -image_size / 2, -image_size / 2, image_size / 2))
-
-    plt.setp(axs[1, 0], ylabel=r"$\Delta$ decl. (arcsec)")
-    plt.setp(axs[1, 1], xlabel=r"$\Delta$ R.A. (arcsec)")
-
-    d1 = make_axes_locatable(axs[1, 0])
-    axs[1, 0].set_xticks((-asec_spacing, 0, asec_spacing))
-    axs[1, 0].set_yticks((-asec_spacing, 0, asec_spacing))
-    cax1 = d1.append_axes("top", size="10%", pad=0.3)
-    cbar1 = plt.colorbar(firstfig, cax=cax1, orientation="horizontal", ticks=(0, nuc_flux_spacing, 2*nuc_flux_spacing, 3*nuc_flux_spacing, 4*nuc_flux_spacing))
-    cbar1.ax.tick_params(top=True, bottom=False, pad=-30)
-    cbar1.ax.set_xlabel("Flux (mJy/beam)", fontdict={'fontsize': 8.5})
-    cbar1.ax.set_xticklabels(['0', 1000*nuc_flux_spacing, 2*1000*nuc_flux_spacing, 3*1000*nuc_flux_spacing, 4*1000*nuc_flux_spacing])
-
-    d2 = make_axes_locatable(axs[1, 1])
-    axs[1, 1].set_xticks((-asec_spacing, 0, asec_spacing))
-    axs[1, 1].set_yticks((-asec_spacing, 0, asec_spacing))
-    cax2 = d2.append_axes("top", size="10%", pad=0.3)
-    cbar2 = plt.colorbar(secondfig, cax=cax2, orientation="horizontal", ticks=(-2*ext_flux_spacing, -ext_flux_spacing, 0, ext_flux_spacing, 2*ext_flux_spacing))
-    cbar2.ax.tick_params(top=True, bottom=False, pad=-30)
-    cbar2.ax.set_xlabel("Flux (mJy/beam)", fontdict={'fontsize': 8.5})
-    cbar2.ax.set_xticklabels([-2*ext_flux_spacing*1000, -ext_flux_spacing*1000, '0.0', ext_flux_spacing*1000, 2*ext_flux_spacing*1000])
-
-    d3 = make_axes_locatable(axs[1, 2])
-    axs[1, 2].set_xticks((-asec_spacing, 0, asec_spacing))
-    axs[1, 2].set_yticks((-asec_spacing, 0, asec_spacing))
-    cax3 = d3.append_axes("top", size="10%", pad=0.3)
-    cbar3 = plt.colorbar(thirdfig, cax=cax3, orientation="horizontal", ticks=(-2*ext_flux_spacing, -ext_flux_spacing, 0, ext_flux_spacing, 2*ext_flux_spacing))
-    cbar3.ax.tick_params(top=True, bottom=False, pad=-30)
-    cbar3.ax.set_xlabel("Flux (mJy/beam)", fontdict={'fontsize': 8.5})
-    cbar3.ax.set_xticklabels([-2*ext_flux_spacing*1000, -ext_flux_spacing*1000, '0.0', ext_flux_spacing*1000, 2*ext_flux_spacing*1000])
-
-    plt.savefig(save_folder + "\\" + g.name.replace(" ", "") + "_sed_w_alma_images", dpi=500)
-    plt.show()
+
+def sed_alma_panel(g, save_folder, show=True):
+    # Plots the SED of a galaxy above its ALMA continuum maps from fits_loc (see alma_panel.render_panel)
+    index = alma_panel.scan_fits(fits_loc)
+    files = alma_panel.panel_files(g.name, index)
+    if files is None:
+        print("\n**No panel for " + g.name + ", missing FITS images: " +
+              ", ".join(alma_panel.missing_products(g.name, index)) + "**")
+        return None
+    return alma_panel.render_panel(g, save_folder, files, show=show)
 
 
 # FOLLOWING: Main function/menu loop
-menu_loop = True
-while menu_loop is True:
-    print("\nMain Menu:\n",
-          "\t0: Select target\n",
-          "\t1: Print all SEDs\n",
-          "\t2: Print set of SEDs\n",
-          "\t3: Print SED next to ALMA images\n"
-          "\t4: Quit\n")
-    user_selection = input("Enter selection:")
-    if user_selection == '0':
-        select_target_menu()
-    elif user_selection == '1':
-        print("Printing all SEDs.  This could take a few minutes . . . ")
-        print_all_seds()
-        menu_loop = False
-    elif user_selection == '2':
-        print_set_of_seds()
-        menu_loop = False
-    elif user_selection == '3':
-        sed_w_alma()
-        menu_loop = False
-    elif user_selection == '4':
-        menu_loop = False
+def main_menu(jobs=None):
+    menu_loop = True
+    while menu_loop is True:
+        print("\nMain Menu:\n",
+              "\t0: Select target\n",
+              "\t1: Print all SEDs\n",
+              "\t2: Print set of SEDs\n",
+              "\t3: Print SED next to ALMA images\n"
+              "\t4: Quit\n")
+        startup.mark("first prompt")
+        user_selection = input("Enter selection:")
+        if user_selection == '0':
+            select_target_menu()
+        elif user_selection == '1':
+            print("Printing all SEDs.  This could take a few minutes . . . ")
+            print_all_seds(jobs=jobs)
+            menu_loop = False
+        elif user_selection == '2':
+            print_set_of_seds()
+            menu_loop = False
+        elif user_selection == '3':
+            sed_w_alma()
+            menu_loop = False
+        elif user_selection == '4':
+            menu_loop = False
+        else:
+            print("Invalid input -- quitting program . . . ")
+            menu_loop = False
+    if startup.is_loaded(spin):
+        print(spin.session.report())
+
+
+# FOLLOWING: Command line jobs
+
+def run_job(job, jobs=None):
+    # Runs one job: a dict with an "action" (render, fit, clear, list, grid or alma-panel) and the "targets" it applies
+    # to (galaxy names, or fit specs for "fit"; every galaxy if left out), along with any options of that action:
+    #     render:      "folder", "z_range" ([min, max]), "telescopes" (targets with a point from any of them), "csv"
+    #                  (a CSV export to read the galaxies from instead of the workbook)
+    #     fit:         "defaults", and the spec keys of batch.load_fit_specs in each target
+    #     clear:       "model" (required)
+    #     grid:        "output", "rows", "cols", "bold" (names of targets drawn with thick spines)
+    #     alma-panel:  "folder", "fits_folder"
+    # Every job run in this process shares the catalog and fits of the current backend (the workbook, --database or
+    # --seds-csv).
+    action = job["action"]
+    if action == "render" and "targets" not in job:  # Streamed, so the whole target list is never looked up
+        specs = []
+    else:
+        specs = batch.expand_fit_specs(job)
+    names = [spec["name"] for spec in specs]
+
+    if action == "render":
+        # Galaxies are streamed from the current backend (see spin.iter_galaxies), or from a CSV export (see
+        # file_read.iter_galaxies)
+        filters = {"z_range": job.get("z_range"), "telescopes": job.get("telescopes")}
+        if "targets" in job:
+            filters["names"] = names
+        if "csv" in job:
+            galaxies = file_read.iter_galaxies(job["csv"], **filters)
+        else:
+            galaxies = spin.iter_galaxies(**filters)
+        results = batch.render_seds(job.get("folder", sed_folder), jobs=jobs, galaxies=galaxies)
+        if "targets" in job:
+            # The stream skips names it doesn't find and yields in catalog order, so put the results back in the order
+            # given and fail the names it never yielded
+            found = {result.name: result for result in results}
+            missing = "not in the catalog"
+            if job.get("z_range") is not None or job.get("telescopes") is not None:
+                missing += " or filtered out by z_range/telescopes"
+            results = [found.get(name, batch.TargetResult(name, False, error=missing)) for name in names]
+    elif action == "fit":
+        results = batch.fit_galaxies(specs, jobs=jobs)
+    elif action == "clear":
+        spin.write_fits([], cleared=[(name, job["model"]) for name in names])
+        results = [batch.TargetResult(name, True, output="cleared " + job["model"] + " fits") for name in names]
+    elif action == "list":
+        for name in names:
+            print_saved_fits(name)
+        results = []
+    elif action == "grid":
+        results = sed_grid(names, job.get("output", grid_folder + "\\all_seds_w_alma"), show=False,
+                           rows=job.get("rows", 3), cols=job.get("cols", 7), bold=job.get("bold", ()), jobs=jobs)
+    elif action == "alma-panel":
+        results = batch.render_alma_panels(job.get("folder", alma_folder), job.get("fits_folder", fits_loc), names,
+                                           jobs=jobs)
+    else:
+        raise ValueError("Unknown action " + repr(action))
+
+    if results:
+        batch.print_report(results)
+    return results
+
+
+def load_jobs(location):
+    # Reads jobs (see run_job) from a JSON or YAML file holding a single job, a list of jobs, or an object with
+    # "jobs" and "defaults" (options applied to every job), e.g.
+    #     jobs:
+    #       - action: fit
+    #         defaults: {model: mod_blackbody, replace: true, realizations: 1000}
+    #         targets: [NGC 612, {name: NGC 1399, range: [0, 12], exclude: [4]}]
+    #       - action: render
+    contents = batch.read_job_file(location)
+    if isinstance(contents, dict) and "action" in contents:
+        contents = [contents]
+    if isinstance(contents, list):
+        contents = {"jobs": contents}
+
+    jobs = []
+    for job in contents["jobs"]:
+        jobs.append(dict(contents.get("defaults", {})))
+        jobs[-1].update(job)
+    return jobs
+
+
+def command_line_job(args):
+    # Builds the job (see run_job) given by a subcommand's arguments
+    job = {"action": args.command}
+    if args.targets:
+        job["targets"] = args.targets
+    if args.command == "fit":
+        job["defaults"] = {"model": args.model, "subtract": args.subtract, "replace": args.replace,
+                           "realizations": args.realizations, "linestyle": args.linestyle}
+        for key in ("range", "exclude", "hold", "seed"):
+            if getattr(args, key) is not None:
+                job["defaults"][key] = getattr(args, key)
+    elif args.command == "clear":
+        job["model"] = args.model
+    elif args.command == "render":
+        for key in ("folder", "z_range", "telescopes", "csv"):
+            if getattr(args, key) is not None:
+                job[key] = getattr(args, key)
+    elif args.command == "alma-panel":
+        for key in ("folder", "fits_folder"):
+            if getattr(args, key) is not None:
+                job[key] = getattr(args, key)
+    elif args.command == "grid":
+        job.update({"rows": args.rows, "cols": args.cols, "bold": args.bold})
+        if args.output is not None:
+            job["output"] = args.output
+    return job
+
+
+def argument_parser():
+    parser = argparse.ArgumentParser(description="Plot and fit galaxy SEDs.  Runs the interactive menu if no command "
+                                                 "is given.")
+    parser.add_argument("--jobs", type=int, default=None,
+                        help="number of worker processes for batch rendering and fitting (default: one per CPU)")
+    parser.add_argument("--render-all", action="store_true",
+                        help="save every SED without going through the menu (same as the render command)")
+    parser.add_argument("--fit", metavar="SPEC_FILE",
+                        help="run the fits described in a JSON/YAML spec file (see batch.load_fit_specs) and save them")
+    parser.add_argument("--profile-startup", action="store_true",
+                        help="print how long startup and each lazily imported module took")
+    parser.add_argument("--database", metavar="DATABASE",
+                        help="read and save the SEDs and fits in this SQLite database instead of the workbook (see "
+                             "the db-import command)")
+    parser.add_argument("--seds-csv", metavar="CSV",
+                        help="read the SEDs from a CSV export of the SEDs sheet instead (fits are still read from and "
+                             "saved to the workbook or --database)")
+    commands = parser.add_subparsers(dest="command", metavar="COMMAND")
+
+    # Lets --jobs also be given after the command
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--jobs", type=int, default=argparse.SUPPRESS, help="number of worker processes")
+
+    command = commands.add_parser("run", parents=[common], help="run every job in JSON/YAML job files (see load_jobs)")
+    command.add_argument("job_files", nargs="+", metavar="JOB_FILE")
+
+    command = commands.add_parser("render", parents=[common],
+                                  help="save the SEDs of the given targets (all by default)")
+    command.add_argument("targets", nargs="*", metavar="TARGET")
+    command.add_argument("--folder", help="folder to save the SEDs in")
+    command.add_argument("--z-range", type=float, nargs=2, metavar=("MIN", "MAX"), help="only targets with z in range")
+    command.add_argument("--telescopes", nargs="+", metavar="TELESCOPE",
+                         help="only targets with a point from any of these telescopes")
+    command.add_argument("--csv", help="read the galaxies from a CSV export of the SEDs sheet instead")
+
+    command = commands.add_parser("fit", parents=[common],
+                                  help="fit the given targets (all by default) and save the fits")
+    command.add_argument("targets", nargs="*", metavar="TARGET")
+    command.add_argument("--model", default="mod_blackbody", help="fit model (default: mod_blackbody)")
+    command.add_argument("--range", type=int, nargs=2, metavar=("START", "END"), help="points to fit")
+    command.add_argument("--exclude", type=int, nargs="+", metavar="INDEX", help="points to leave out of the fit")
+    command.add_argument("--hold", type=float, nargs="+", metavar="VALUE",
+                         help="parameter values to hold (0 leaves a parameter free)")
+    command.add_argument("--linestyle", default="solid", help="matplotlib linestyle of the saved fit")
+    command.add_argument("--subtract", action="store_true", help="fit what's left after subtracting the saved fits")
+    command.add_argument("--replace", action="store_true", help="clear saved fits of the same model first")
+    command.add_argument("--realizations", type=int, default=0, help="Monte Carlo realizations for percentiles")
+    command.add_argument("--seed", type=int, help="random seed for the Monte Carlo realizations")
+
+    command = commands.add_parser("clear", parents=[common],
+                                  help="clear the saved fits of a model for the given targets")
+    command.add_argument("targets", nargs="+", metavar="TARGET")
+    command.add_argument("--model", required=True, help="fit model to clear")
+
+    command = commands.add_parser("list", parents=[common],
+                                  help="list the saved fits of the given targets (all by default)")
+    command.add_argument("targets", nargs="*", metavar="TARGET")
+
+    command = commands.add_parser("grid", parents=[common], help="save the SEDs of the given targets on one grid")
+    command.add_argument("targets", nargs="+", metavar="TARGET")
+    command.add_argument("--output", help="file to save the grid to (numbered _pageN if there are several pages)")
+    command.add_argument("--rows", type=int, default=3, help="rows of subplots on each page (default: 3)")
+    command.add_argument("--cols", type=int, default=7, help="columns of subplots on each page (default: 7)")
+    command.add_argument("--bold", nargs="+", default=[], metavar="TARGET", help="targets to draw with thick spines")
+
+    command = commands.add_parser("alma-panel", parents=[common],
+                                  help="save SED and ALMA image panels of the given targets (all by default)")
+    command.add_argument("targets", nargs="*", metavar="TARGET")
+    command.add_argument("--folder", help="folder to save the panels in")
+    command.add_argument("--fits-folder", help="folder holding the ALMA FITS images (default: fits_loc)")
+
+    command = commands.add_parser("db-import", help="copy the workbook's SEDs, fits and point styles into an SQLite "
+                                                    "database, replacing what it held")
+    command.add_argument("db_location", metavar="DATABASE")
+
+    command = commands.add_parser("db-export", help="write an SQLite database out in the workbook layout")
+    command.add_argument("db_location", metavar="DATABASE")
+    command.add_argument("output", metavar="OUTPUT", help=".xlsx file to write")
+    command.add_argument("--template", help="workbook whose other sheets, labels and formatting are kept")
+    return parser
+
+
+if __name__ == "__main__":
+    args = argument_parser().parse_args()
+    if args.database is not None:
+        spin.use_backend(sqlite_backend.SqliteBackend(args.database))
+    if args.seds_csv is not None:
+        spin.use_backend(file_read.CsvBackend(args.seds_csv))
+
+    if args.command == "db-import":
+        database = sqlite_backend.SqliteBackend(args.db_location)
+        database.import_workbook()
+        print("Imported " + str(len(database.catalog())) + " galaxies into " + args.db_location)
+    elif args.command == "db-export":
+        print("Saved " + sqlite_backend.SqliteBackend(args.db_location).export_workbook(args.output,
+                                                                                      template=args.template))
+    elif args.command == "run":
+        for job_file in args.job_files:
+            for job in load_jobs(job_file):
+                run_job(job, jobs=args.jobs)
+    elif args.command is not None:
+        run_job(command_line_job(args), jobs=args.jobs)
+    elif args.fit is not None:
+        batch.print_report(batch.fit_galaxies(batch.load_fit_specs(args.fit), jobs=args.jobs))
+    elif args.render_all:
+        print_all_seds(jobs=args.jobs)
     else:
-        print("Invalid input -- quitting program . . . ")
-        menu_loop = False
+        main_menu(jobs=args.jobs)
+    if args.profile_startup:
+        print(startup.report())
 
 # Set 1: ic1531, ngc612, pks718, ngc3100, eso443, ngc3557, ic4296, ngc7075, ic1459
 # Set 2: ngc4945, ngc1399, ngc4594, ngc4751, ngc6861, ngc1600
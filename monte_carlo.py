@@ -0,0 +1,74 @@
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+import fit_models
+
+
+# FOLLOWING: Constants
+PERCENTILES = (16, 50, 84)
+
+
+# FOLLOWING: Resampling
+
+def perturb(flux, err, num_realizations, rng):
+    # Returns num_realizations copies of flux (one per row), with every point shifted by a normal deviate of width err
+    return flux + err * rng.standard_normal((num_realizations, len(flux)))
+
+
+def fit_realizations(fit_type, freq, fluxes, err, hold, z, distance, p0):
+    # Fits every row of fluxes with the same compiled model.  Returns the full best-fit parameters of each realization
+    # (one per row), with NaN for fits that fail.
+    compiled = fit_models.models[fit_type].compile(hold, z, distance)
+    samples = np.full((len(fluxes), len(compiled.fit_model.param_names)), np.nan)
+
+    for i in range(len(fluxes)):
+        try:
+            fitobj, samples[i] = fit_models.fit_compiled(compiled, freq, fluxes[i], err=err, p0=p0)
+        except Exception:
+            pass
+
+    return samples
+
+
+def resample(fit_type, freq, flux, err, best_params, hold=(), z=0, distance=1, num_realizations=1000, jobs=None,
+             seed=None, batch_size=100):
+    # Refits num_realizations copies of the data with the fluxes perturbed within their errors, starting each fit from
+    # best_params.  Realizations are fit in batches of batch_size across 'jobs' worker processes (one per CPU by
+    # default, or in this process if jobs is 1).  Returns an array of parameters with one row per realization.
+    freq = np.asarray(freq, dtype=float)
+    flux = np.asarray(flux, dtype=float)
+    err = np.asarray(err, dtype=float)
+    compiled = fit_models.models[fit_type].compile(hold, z, distance)
+    p0 = [best_params[i] for i in compiled.free_index]
+
+    fluxes = perturb(flux, err, num_realizations, np.random.default_rng(seed))
+    batches = [fluxes[i:i + batch_size] for i in range(0, num_realizations, batch_size)]
+
+    if jobs == 1:
+        samples = [fit_realizations(fit_type, freq, fluxes_batch, err, hold, z, distance, p0)
+                   for fluxes_batch in batches]
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            futures = [pool.submit(fit_realizations, fit_type, freq, fluxes_batch, err, hold, z, distance, p0)
+                       for fluxes_batch in batches]
+            samples = [future.result() for future in futures]
+
+    return np.concatenate(samples)
+
+
+def num_failed(samples):
+    # Number of realizations (rows of samples) whose fit failed
+    return int(np.count_nonzero(~np.all(np.isfinite(samples), axis=1)))
+
+
+def summarize(samples, percentiles=PERCENTILES):
+    # Returns the given percentiles of each parameter, ignoring failed fits, flattened parameter by parameter as
+    # [p1_16, p1_50, p1_84, p2_16, ...].  Parameters without a single finite value get None for every percentile, so
+    # they're saved as empty cells.
+    summary = []
+    for column in np.asarray(samples, dtype=float).T:
+        values = column[np.isfinite(column)]
+        if len(values) == 0:
+            summary += [None] * len(percentiles)
+        else:
+            summary += [float(value) for value in np.percentile(values, percentiles)]
+    return summary
@@ -0,0 +1,91 @@
+import os
+import time
+import tempfile
+import startup
+import spreadsheet_interface as spin
+import galaxy
+
+plt = startup.lazy_import("matplotlib.pyplot")
+
+
+# FOLLOWING: Reusable SED figure
+
+class SedTemplate:
+    # An SED figure whose fixed parts (log axes, ticks, the wavelength axis and PAH boxes, see
+    # galaxy.decorate_sed_axes) are drawn once.  Each save only swaps in a galaxy's points, error bars, fits, title,
+    # legend and limits (see Galaxy.plot_sed).  With relayout=False, the layout from tight_layout is worked out for
+    # the first galaxy and kept for the rest, which is faster but can clip the labels of galaxies whose axes come out
+    # a different shape.
+
+    def __init__(self, scaling=1, relayout=True):
+        self.scaling = scaling
+        self.relayout = relayout
+        self.fig = plt.figure()
+        self.axes = self.fig.add_subplot()
+        galaxy.decorate_sed_axes(self.axes, scaling=scaling)
+        self.artists = []
+        self.laid_out = False
+
+    def draw(self, g):
+        for artist in self.artists:
+            artist.remove()
+        self.artists = g.plot_sed(self.axes, scaling=self.scaling)
+        if self.relayout or not self.laid_out:
+            self.fig.tight_layout(h_pad=1.8*self.scaling)
+            self.laid_out = True
+
+    def save(self, g, location):
+        # Draws a galaxy and saves the figure to location
+        self.draw(g)
+        self.fig.savefig(location)
+        return location
+
+    def close(self):
+        plt.close(self.fig)
+
+
+# FOLLOWING: Benchmark
+
+def benchmark(names=None, save_folder=None):
+    # Times saving the SEDs of 'names' (all targets by default) with display_sed, which rebuilds the whole figure for
+    # each galaxy, and with one SedTemplate (with and without relayout).  Files go to a temporary folder unless
+    # save_folder is given.  Returns {"rebuild": seconds, "template": seconds, "fixed layout": seconds}.
+    if names is None:
+        names = spin.target_list()
+    galaxies = [spin.get_set_named(name) for name in names]
+
+    with tempfile.TemporaryDirectory() as temp_folder:
+        if save_folder is None:
+            save_folder = temp_folder
+        timings = {}
+        for subfolder in ("rebuild", "template", "fixed layout"):
+            os.makedirs(os.path.join(save_folder, subfolder), exist_ok=True)
+
+        start = time.perf_counter()
+        for g in galaxies:
+            g.display_sed(savefig=True, savefolder=os.path.join(save_folder, "rebuild"))
+        timings["rebuild"] = time.perf_counter() - start
+        plt.close('all')
+
+        for subfolder, relayout in (("template", True), ("fixed layout", False)):
+            start = time.perf_counter()
+            template = SedTemplate(relayout=relayout)
+            for g in galaxies:
+                template.save(g, os.path.join(save_folder, subfolder, "sed_" + g.name))
+            template.close()
+            timings[subfolder] = time.perf_counter() - start
+
+    return timings
+
+
+if __name__ == "__main__":
+    import matplotlib
+    matplotlib.use('Agg')
+
+    timings = benchmark()
+    print("Saved " + str(len(spin.target_list())) + " SEDs:")
+    print("\tRebuilding each figure: " + str(round(timings["rebuild"], 3)) + " s")
+    print("\tReusing one template: " + str(round(timings["template"], 3)) + " s (" +
+          str(round(timings["rebuild"] / timings["template"], 2)) + "x)")
+    print("\tReusing one template and layout: " + str(round(timings["fixed layout"], 3)) + " s (" +
+          str(round(timings["rebuild"] / timings["fixed layout"], 2)) + "x)")
@@ -1,227 +1,770 @@
-import openpyxl as opxl
+import os
+import hashlib
+import itertools
+import numpy as np
+import startup
 import galaxy
 
+opxl = startup.lazy_import("openpyxl")  # Not needed while the sidecar cache is current
+
 
 # FOLLOWING: Constants
 spreadsheet_loc = "C:\\Users\\bderi\\Box\\School\\Research Boizelle\\ALMA Archive Galaxy Observations with SED Flux Densities.xlsx"
+sidecar_loc = os.path.splitext(spreadsheet_loc)[0] + ".sedcache.npz"  # Binary copy of the parsed workbook
+PERCENTILE_LABELS = ["16%", "50%", "84%"]  # Percentile columns saved after each fit's linestyle (see monte_carlo)
+FIT_COLUMNS = 8 + 3*len(PERCENTILE_LABELS)  # Columns in "Fit Parameters"
+
+
+# FOLLOWING: Workbook session
+
+def file_stamp(location):
+    # (modification time in ns, size) of a file, which changes whenever the file is written
+    stat = os.stat(location)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def atomic_save(location, write):
+    # Saves a file by calling write(temporary location) and then replacing location with the temporary file, so an
+    # interrupted save never leaves half a file behind.  The temporary file keeps location's extension (some writers,
+    # e.g. np.savez, depend on it) and is removed if the write fails.
+    root, extension = os.path.splitext(location)
+    temp_location = root + ".tmp" + extension
+    try:
+        write(temp_location)
+        os.replace(temp_location, location)
+    except:
+        if os.path.exists(temp_location):
+            os.remove(temp_location)
+        raise
+
+
+class WorkbookSession:
+    # Keeps the workbook loaded for the whole run instead of parsing the .xlsx again in every function.  One copy is
+    # kept for reading (data_only, read_only) and one for writing, and a copy is only reloaded when the file on disk
+    # changes (different modification time or size).
+
+    def __init__(self, location):
+        self.location = location
+        self.workbooks = {}  # read_only (bool) -> (file stamp, workbook)
+        self.pid = os.getpid()  # Process the cached copies were loaded in
+        self.loads = 0
+        self.loads_avoided = 0  # Including reads of the parsed workbook from memory or the sidecar (see workbook_data)
+        self.sidecar_loads = 0
+
+    def file_stamp(self):
+        return file_stamp(self.location)
+
+    def workbook(self, read_only=True):
+        # Returns the cached workbook for the given mode, loading it again only if the file has changed
+        if self.pid != os.getpid():
+            # A forked worker process can't share the parent's open read-only file, so it loads its own copies (the
+            # parent's aren't closed, since the parent still uses them)
+            self.workbooks = {}
+            self.pid = os.getpid()
+        stamp = self.file_stamp()
+        if read_only in self.workbooks:
+            cached_stamp, wb = self.workbooks[read_only]
+            if cached_stamp == stamp:
+                self.loads_avoided += 1
+                return wb
+            self.close(read_only)
+
+        if read_only:
+            wb = opxl.load_workbook(self.location, data_only=True, read_only=True)
+        else:
+            wb = opxl.load_workbook(self.location)
+        self.loads += 1
+        self.workbooks[read_only] = (stamp, wb)
+        return wb
+
+    def save(self, wb):
+        # Saves the write copy, keeping it valid for the next write.  The read copy is stale after this (and holds the
+        # file open in read-only mode), so it gets closed.  The save is atomic (see atomic_save).
+        self.close(True)
+        atomic_save(self.location, wb.save)
+        self.workbooks[False] = (self.file_stamp(), wb)
+
+    def close(self, read_only=None):
+        # Drops one cached copy, or both if read_only is None
+        for mode in ([True, False] if read_only is None else [read_only]):
+            if mode in self.workbooks:
+                stamp, wb = self.workbooks.pop(mode)
+                if mode:
+                    wb.close()
+
+    def report(self):
+        return ("Workbook loads: " + str(self.loads) + ", loads avoided: " + str(self.loads_avoided) + " (" +
+                str(self.sidecar_loads) + " read from the sidecar)")
+
+
+session = WorkbookSession(spreadsheet_loc)
+
+# FOLLOWING: SED catalog
+
+def _sheet_value(value):
+    # Cells reading "None" stand for a value of 0
+    if type(value) is str and (("None" in value) or ("none" in value)):
+        return 0.0
+    return value
+
+
+def _is_limit(value):
+    return (value == 'Limit') or (value == 'limit')
+
+
+def _row_values(row, length=None):
+    # Returns the values of a row from column C up to the first empty cell (or exactly 'length' values, padded with None)
+    values = []
+    for value in row[2:]:
+        if value is None or (length is not None and len(values) == length):
+            break
+        values.append(_sheet_value(value))
+    if length is not None:
+        values += [None] * (length - len(values))
+    return values
+
+
+def _float_array(values):
+    # Anything that isn't a number (empty cells, limit markers) becomes NaN
+    array = np.full(len(values), np.nan)
+    for i in range(len(values)):
+        if values[i] is not None and not isinstance(values[i], str):
+            array[i] = values[i]
+    return array
+
+
+class SedCatalog:
+    # Every galaxy on the "SEDs" sheet, read in a single pass.  The points of all galaxies are stored column by column:
+    # one array per quantity, where galaxy n owns the slice offsets[n]:offsets[n+1].  Limits are kept as boolean masks,
+    # with the matching uncertainty set to NaN.
+
+    def __init__(self, names, offsets, freq, telescopes, flux, unc_upper, unc_lower, upper_limits, lower_limits,
+                 z, distance):
+        self.names = names
+        self.offsets = offsets
+        self.freq = freq
+        self.telescopes = telescopes
+        self.flux = flux
+        self.unc_upper = unc_upper
+        self.unc_lower = unc_lower
+        self.upper_limits = upper_limits
+        self.lower_limits = lower_limits
+        self.z = z
+        self.distance = distance
+        self.index = {}
+        for i in range(len(names)):
+            self.index.setdefault(names[i], i)
+
+    @classmethod
+    def from_rows(cls, rows, lines_per_data_set):
+        # Builds the catalog from the sheet's rows (tuples of values, starting at row 1)
+        rows = list(rows)
+        names = []
+        offsets = [0]
+        freq, telescopes, flux, unc_upper, unc_lower, z, distance = [], [], [], [], [], [], []
+
+        init_row = 1
+        while init_row < len(rows) and len(rows[init_row]) > 0 and rows[init_row][0] is not None:
+            block = rows[init_row:init_row + lines_per_data_set] + [()] * lines_per_data_set
+            cur_freq = _row_values(block[0])
+            num_points = len(cur_freq)
+
+            names.append(block[0][0])
+            freq += cur_freq
+            telescopes += _row_values(block[1], num_points)
+            flux += _row_values(block[2], num_points)
+            unc_upper += _row_values(block[3], num_points)
+            unc_lower += _row_values(block[4], num_points)
+            z.append(block[5][2] if len(block[5]) > 2 else None)
+            distance.append(block[6][2] if len(block[6]) > 2 else None)
+            offsets.append(len(freq))
+
+            init_row += lines_per_data_set + 1
+
+        return cls(names, np.array(offsets), _float_array(freq), np.array(telescopes, dtype=object),
+                   _float_array(flux), _float_array(unc_upper), _float_array(unc_lower),
+                   np.array([_is_limit(value) for value in unc_upper], dtype=bool),
+                   np.array([_is_limit(value) for value in unc_lower], dtype=bool),
+                   _float_array(z), _float_array(distance))
+
+    def __len__(self):
+        return len(self.names)
+
+    def galaxy(self, n):
+        # Returns the nth galaxy as a Galaxy class
+        start, end = self.offsets[n], self.offsets[n+1]
+        return galaxy.Galaxy(self.names[n], self.freq[start:end], self.telescopes[start:end], self.flux[start:end],
+                             self.unc_upper[start:end], self.unc_lower[start:end], float(self.z[n]),
+                             float(self.distance[n]), upper_limits=self.upper_limits[start:end],
+                             lower_limits=self.lower_limits[start:end])
+
+    def galaxy_named(self, galaxy_name):
+        return self.galaxy(self.index[galaxy_name])
+
+
+# FOLLOWING: Parsed workbook cache
+
+def _str_array(values):
+    # Empty cells are stored as empty strings
+    return np.array(['' if value is None else str(value) for value in values], dtype=str)
+
+
+def _from_str_array(array):
+    return [None if value == '' else str(value) for value in array]
+
+
+def _from_float_array(array):
+    values = []
+    for value in array.tolist():
+        if np.isnan(value):
+            values.append(None)
+        elif value.is_integer():
+            values.append(int(value))
+        else:
+            values.append(value)
+    return values
+
+
+def file_digest(location):
+    sha1 = hashlib.sha1()
+    with open(location, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+class FitTable:
+    # The "Fit Parameters" sheet indexed by galaxy name.  'rows' holds every row from row 2 down (FIT_COLUMNS values
+    # each), and 'spans' maps each galaxy name to the (start, stop) slice of rows holding its section.  The index is
+    # built in one pass and kept up to date on writes, so finding a galaxy never depends on scanning past blank rows.
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.spans = {}
+
+        # A section starts with the galaxy's name in column A and runs until the next name or blank row
+        galaxy_name = None
+        start = 0
+        for i in range(len(rows) + 1):
+            if i == len(rows) or rows[i][0] is not None or rows[i][1] is None:
+                if galaxy_name is not None and galaxy_name not in self.spans:
+                    self.spans[galaxy_name] = (start, i)
+                galaxy_name = None
+                if i < len(rows) and rows[i][0] is not None:
+                    galaxy_name = rows[i][0]
+                    start = i
+
+    def fits(self, galaxy_name):
+        # Returns the galaxy's rows that hold a fit
+        start, stop = self.spans.get(galaxy_name, (0, 0))
+        return [row for row in self.rows[start:stop] if row[1] is not None]
+
+    def insert_row(self, index, row, galaxy_name=None):
+        # Inserts a row before rows[index], shifting the sections below it.  The row becomes the last one of
+        # galaxy_name's section if given (or the first one of a new section if it's the name row).
+        self.rows.insert(index, row)
+        for name in self.spans:
+            if self.spans[name][0] >= index:
+                self.spans[name] = (self.spans[name][0] + 1, self.spans[name][1] + 1)
+        if galaxy_name in self.spans:
+            self.spans[galaxy_name] = (self.spans[galaxy_name][0], self.spans[galaxy_name][1] + 1)
+        elif galaxy_name is not None:
+            self.spans[galaxy_name] = (index, index + 1)
+
+    def delete_row(self, index):
+        # Deletes rows[index], shifting the sections below it, and removes any section left empty
+        del self.rows[index]
+        for name in list(self.spans):
+            start, stop = self.spans[name]
+            if start > index:
+                self.spans[name] = (start - 1, stop - 1)
+            elif stop > index:
+                self.spans[name] = (start, stop - 1)
+                if start == stop - 1:
+                    del self.spans[name]
+
+    def add_fit(self, galaxy_name, row):
+        # Adds a fit row at the end of the galaxy's section (a new section goes after the last one).  Returns the row
+        # edits made, as in apply.
+        if galaxy_name in self.spans and self.rows[self.spans[galaxy_name][0]][1] is None:  # Only the name row left
+            self.rows[self.spans[galaxy_name][0]] = [galaxy_name] + list(row[1:])
+            return []
+        if galaxy_name in self.spans:
+            index = self.spans[galaxy_name][1]
+            self.insert_row(index, [None] + list(row[1:]), galaxy_name)
+        else:
+            index = max([span[1] for span in self.spans.values()], default=0)
+            self.insert_row(index, [galaxy_name] + list(row[1:]), galaxy_name)
+        return [('insert', index)]
+
+    def clear_fits(self, galaxy_name, fit_type):
+        # Deletes the galaxy's fits of the given type, moving its name to the first row left.  If none are left, the
+        # name row is kept with its fit columns emptied, so the galaxy keeps its place on the sheet.  Returns the row
+        # edits made, as in apply.
+        start, stop = self.spans.get(galaxy_name, (0, 0))
+        edits = []
+        for index in range(stop - 1, start - 1, -1):
+            if self.rows[index][1] == fit_type:
+                if index == start and self.spans[galaxy_name][1] == start + 1:
+                    self.rows[start] = [galaxy_name] + [None] * (FIT_COLUMNS - 1)
+                else:
+                    self.delete_row(index)
+                    edits.append(('delete', index))
+        if galaxy_name in self.spans:
+            self.rows[start][0] = galaxy_name
+        return edits
+
+    def apply(self, operations):
+        # Applies queued FitTransaction operations.  Returns the rows inserted and deleted, in order, as ('insert',
+        # index) and ('delete', index), so that a sheet can have the same whole rows moved (see _apply_fit_operations).
+        edits = []
+        for operation in operations:
+            if operation[0] == 'clear':
+                edits += self.clear_fits(operation[1], operation[2])
+            else:
+                edits += self.add_fit(operation[1], operation[2])
+        return edits
+
+
+class WorkbookData:
+    # The parsed contents of the "SEDs", "Fit Parameters" and "Point Styles" sheets.  The first parse of a workbook is
+    # written to a .npz sidecar next to it, and later runs load that instead of opening the .xlsx, as long as the
+    # workbook's modification time and size (or failing that, its SHA-1 hash) still match.
+
+    def __init__(self, stamp, digest, lines_per_data_set, catalog, fit_table, point_styles):
+        self.stamp = stamp  # (mtime in ns, size) of the workbook this was parsed from
+        self.digest = digest
+        self.lines_per_data_set = lines_per_data_set
+        self.catalog = catalog
+        self.fit_table = fit_table
+        self.point_styles = point_styles
+
+    @classmethod
+    def parse(cls):
+        stamp = session.file_stamp()
+        digest = file_digest(session.location)
+        wb = session.workbook()
+
+        # SEDs; the second galaxy name is one row past the end of the first data set
+        sed_rows = list(wb.get_sheet_by_name("SEDs").iter_rows(values_only=True))
+        lines_per_data_set = None
+        for i in range(2, len(sed_rows)):
+            if len(sed_rows[i]) > 0 and sed_rows[i][0] is not None:
+                lines_per_data_set = i - 2
+                break
+        sed_catalog = SedCatalog.from_rows(sed_rows, lines_per_data_set)
+
+        # Fit Parameters
+        fit_rows = []
+        for row in wb.get_sheet_by_name("Fit Parameters").iter_rows(min_row=2, max_col=FIT_COLUMNS, values_only=True):
+            fit_rows.append(list(row) + [None] * (FIT_COLUMNS - len(row)))
+
+        return cls(stamp, digest, lines_per_data_set, sed_catalog, FitTable(fit_rows), _read_point_styles(wb))
+
+    def save(self, location):
+        c = self.catalog
+        fit_rows = self.fit_table.rows
+        arrays = {
+            'stamp': np.array(self.stamp, dtype=np.int64),
+            'digest': np.array(self.digest),
+            'lines_per_data_set': np.array(self.lines_per_data_set),
+            'sed_names': _str_array(c.names),
+            'sed_offsets': c.offsets,
+            'sed_freq': c.freq,
+            'sed_telescopes': _str_array(c.telescopes),
+            'sed_flux': c.flux,
+            'sed_unc_upper': c.unc_upper,
+            'sed_unc_lower': c.unc_lower,
+            'sed_upper_limits': c.upper_limits,
+            'sed_lower_limits': c.lower_limits,
+            'sed_z': c.z,
+            'sed_distance': c.distance,
+            'fit_names': _str_array([row[0] for row in fit_rows]),
+            'fit_types': _str_array([row[1] for row in fit_rows]),
+            'fit_params': _float_array([row[i] for row in fit_rows for i in range(2, 7)]).reshape(-1, 5),
+            'fit_linestyles': _str_array([row[7] for row in fit_rows]),
+            'fit_percentiles': _float_array([row[i] for row in fit_rows
+                                             for i in range(8, FIT_COLUMNS)]).reshape(-1, FIT_COLUMNS - 8),
+        }
+        for i in range(len(self.point_styles)):
+            arrays['point_styles_' + str(i)] = _str_array(self.point_styles[i])
+
+        atomic_save(location, lambda temp_location: np.savez(temp_location, **arrays))
+
+    @classmethod
+    def load(cls, location):
+        with np.load(location) as arrays:
+            sed_catalog = SedCatalog(_from_str_array(arrays['sed_names']), arrays['sed_offsets'], arrays['sed_freq'],
+                                     np.array(_from_str_array(arrays['sed_telescopes']), dtype=object),
+                                     arrays['sed_flux'], arrays['sed_unc_upper'], arrays['sed_unc_lower'],
+                                     arrays['sed_upper_limits'], arrays['sed_lower_limits'], arrays['sed_z'],
+                                     arrays['sed_distance'])
+
+            fit_rows = []
+            fit_names = _from_str_array(arrays['fit_names'])
+            fit_types = _from_str_array(arrays['fit_types'])
+            fit_linestyles = _from_str_array(arrays['fit_linestyles'])
+            for i in range(len(fit_names)):
+                fit_rows.append([fit_names[i], fit_types[i]] + _from_float_array(arrays['fit_params'][i]) +
+                                [fit_linestyles[i]] + _from_float_array(arrays['fit_percentiles'][i]))
+
+            point_styles = [_from_str_array(arrays['point_styles_' + str(i)]) for i in range(3)]
+
+            return cls(tuple(arrays['stamp'].tolist()), str(arrays['digest']), int(arrays['lines_per_data_set']),
+                       sed_catalog, FitTable(fit_rows), point_styles)
+
+
+def _read_point_styles(wb):
+    # Reads "Point Styles", going from top to bottom and stopping each row at its first empty cell
+    point_styles = []
+    for row in wb.get_sheet_by_name("Point Styles").iter_rows(min_row=1, max_row=3, values_only=True):
+        point_styles.append([row[1]])
+        for value in row[2:]:
+            if value is None:
+                break
+            point_styles[-1].append(value)
+    return point_styles
+
+
+_workbook_data = None  # WorkbookData of the last parse or sidecar load
+
+
+def workbook_data():
+    # Returns the parsed workbook, using (in order) the copy in memory, the sidecar file, or a fresh parse of the .xlsx
+    global _workbook_data
+
+    stamp = session.file_stamp()
+    if _workbook_data is not None and _workbook_data.stamp == stamp:
+        session.loads_avoided += 1
+        return _workbook_data
+
+    data = None
+    if os.path.exists(sidecar_loc):
+        try:
+            data = WorkbookData.load(sidecar_loc)
+        except (OSError, ValueError, KeyError):
+            data = None
+        # A changed timestamp doesn't always mean changed contents (e.g. after the file is synced)
+        if data is not None and data.stamp != stamp:
+            if data.digest == file_digest(session.location):
+                data.stamp = stamp
+                _save_sidecar(data)
+            else:
+                data = None
+
+    if data is None:
+        data = WorkbookData.parse()
+        _save_sidecar(data)
+    else:
+        session.loads_avoided += 1
+        session.sidecar_loads += 1
+
+    _workbook_data = data
+    return data
+
+
+def use_workbook_data(data):
+    # Installs an already parsed workbook (e.g. one handed to a worker process by the parent) as the current one
+    global _workbook_data
+
+    _workbook_data = data
+
+
+def _save_sidecar(data):
+    # The sidecar is only a cache, so failing to write it (e.g. a read-only folder) isn't an error
+    try:
+        data.save(sidecar_loc)
+    except OSError:
+        pass
+
+
+def catalog():
+    # Returns the SED catalog of the current backend (for the workbook, parsing the "SEDs" sheet again only if the
+    # workbook has changed)
+    return backend().catalog()
+
 
 # Gets the constant LINES_PER_DATA_SET
 def lines_per_data_set():
-    wb = opxl.load_workbook(spreadsheet_loc, data_only=True, read_only=True)
-    sheet = wb.get_sheet_by_name("SEDs")
-    found = False
+    return workbook_data().lines_per_data_set
+
+
+def __getattr__(name):
+    # LINES_PER_DATA_SET is looked up from the workbook when first used instead of at import
+    if name == "LINES_PER_DATA_SET":
+        return lines_per_data_set()
+    raise AttributeError("module " + repr(__name__) + " has no attribute " + repr(name))
+
+
+# FOLLOWING: Storage backends
+
+class WorkbookBackend:
+    # Keeps the SEDs, fits and point styles in the workbook at spreadsheet_loc (the default backend).  Every backend
+    # has the same six methods:
+    #     catalog()                                  the SedCatalog of every galaxy
+    #     galaxy_named(galaxy_name)                  one galaxy as a Galaxy class (KeyError if it isn't there)
+    #     iter_galaxies(names, z_range, telescopes)  the galaxies that pass matches_filter, one Galaxy at a time
+    #     fit_rows(galaxy_name)                      the galaxy's saved fits as FIT_COLUMNS-long rows (see FitTable)
+    #     point_styles()                             the names, colors and markers rows of "Point Styles"
+    #     apply_fit_operations(operations)           saves queued FitTransaction operations
+    # Pickling one (e.g. to hand it to a worker process) takes the parsed workbook along if it's in memory, so the
+    # worker doesn't read the file again.
+
+    def catalog(self):
+        return workbook_data().catalog
+
+    def galaxy_named(self, galaxy_name):
+        return workbook_data().catalog.galaxy_named(galaxy_name)
+
+    def iter_galaxies(self, names=None, z_range=None, telescopes=None):
+        # Uses the parsed workbook if it's already in memory and current.  Otherwise the "SEDs" sheet is streamed from
+        # the .xlsx (see sheet_galaxies) rather than parsing the whole catalog first.
+        if _workbook_data is not None and _workbook_data.stamp == session.file_stamp():
+            return catalog_galaxies(_workbook_data.catalog, names=names, z_range=z_range, telescopes=telescopes)
+        rows = session.workbook().get_sheet_by_name("SEDs").iter_rows(values_only=True)
+        return sheet_galaxies(rows, names=names, z_range=z_range, telescopes=telescopes)
+
+    def fit_rows(self, galaxy_name):
+        return workbook_data().fit_table.fits(galaxy_name)
+
+    def point_styles(self):
+        # Read on their own (e.g. for streamed galaxies) unless the parsed workbook is already in memory
+        if _workbook_data is not None and _workbook_data.stamp == session.file_stamp():
+            return _workbook_data.point_styles
+        return _read_point_styles(session.workbook())
+
+    def apply_fit_operations(self, operations):
+        _apply_fit_operations(operations)
+
+    def __getstate__(self):
+        # A workbook that hasn't been parsed (e.g. while galaxies are streamed, see iter_galaxies) isn't parsed just
+        # to be pickled
+        if _workbook_data is not None and _workbook_data.stamp == session.file_stamp():
+            return {"data": _workbook_data}
+        return {"data": None}
+
+    def __setstate__(self, state):
+        if state["data"] is not None:
+            use_workbook_data(state["data"])
+
 
-    cur_row = 1
-    while found is False:
-        cur_row += 1
-        if sheet.cell(row=cur_row+1, column=1).value is not None:
-            found = True
+_backend = WorkbookBackend()  # Used by every read and write function
 
-    return cur_row - 2
 
+def backend():
+    return _backend
+
+
+def use_backend(new_backend):
+    # Makes every read and write function use new_backend (e.g. a sqlite_backend.SqliteBackend) from now on
+    global _backend
+
+    _backend = new_backend
 
-LINES_PER_DATA_SET = lines_per_data_set()
 
 # FOLLOWING: Write functions
 
-def new_fit(galaxy_name, fit_type, parameters, fit_range, linestyle):
-    wb = opxl.load_workbook(spreadsheet_loc)
-    sheet = wb.get_sheet_by_name("Fit Parameters")
+def new_fit(galaxy_name, fit_type, parameters, fit_range, linestyle, percentiles=None):
+    with transaction() as txn:
+        txn.new_fit(galaxy_name, fit_type, parameters, fit_range, linestyle, percentiles=percentiles)
 
-    found = False
-    new_galaxy = False
-
-    # Find galaxy name
-    cur_row = 2
-    while found == False:
-        if sheet.cell(row=cur_row, column=1).value == galaxy_name:
-            found = True
-        elif sheet.cell(row=cur_row, column=2).value == None:
-            found = True
-            new_galaxy = True
-        cur_row += 1
-    cur_row -= 1
-
-    # Insert fit, creating new section for galaxy if it doesn't already exist.
-    if new_galaxy == True:
-        sheet.insert_rows(cur_row)
-        sheet.cell(row=cur_row, column=1).value = galaxy_name
-    if sheet.cell(row=cur_row, column=2).value != None:
-        cur_row += 1
-        sheet.insert_rows(cur_row)
-    sheet.cell(row=cur_row, column=2).value = fit_type
-    for i in range(3, len(parameters)+3):
-        sheet.cell(row=cur_row, column=i).value = parameters[i-3]
-
-    # Insert fit ranges
-    for i in range(6, 8):
-        sheet.cell(row=cur_row, column=i).value = fit_range[i-6]
-
-    # Insert line_style
-    sheet.cell(row=cur_row, column=8).value = linestyle
-
-    wb.save(spreadsheet_loc)
 
 def clear_fits(galaxy_name, fit_type):
-    wb = opxl.load_workbook(spreadsheet_loc)
-    sheet = wb.get_sheet_by_name("Fit Parameters")
+    with transaction() as txn:
+        txn.clear_fits(galaxy_name, fit_type)
+
+
+def write_fits(new_fits, cleared=()):
+    # Clears the saved fits for every (galaxy_name, fit_type) in 'cleared', then adds every
+    # (galaxy_name, fit_type, parameters, fit_range, linestyle[, percentiles]) in 'new_fits', saving the workbook once
+    # at the end.  'percentiles' is a flat list as returned by monte_carlo.summarize.
+    with transaction() as txn:
+        for galaxy_name, fit_type in cleared:
+            txn.clear_fits(galaxy_name, fit_type)
+        for fit in new_fits:
+            txn.new_fit(*fit)
+
+
+def transaction():
+    return FitTransaction()
+
+
+class FitTransaction:
+    # Queues changes to "Fit Parameters" in memory and writes them all at once, with a single save.  Use as
+    #     with spin.transaction() as txn:
+    #         txn.clear_fits(galaxy_name, 'mod_blackbody')
+    #         txn.new_fit(galaxy_name, 'mod_blackbody', parameters, fit_range, 'solid')
+    # The changes are committed when the block ends, and rolled back (nothing is written) if it raises.
+
+    def __init__(self):
+        self.operations = []
+
+    def new_fit(self, galaxy_name, fit_type, parameters, fit_range, linestyle, percentiles=None):
+        row = [None, fit_type] + list(parameters) + [None] * (3 - len(parameters)) + list(fit_range[:2]) + [linestyle]
+        if percentiles is not None:  # Percentiles that couldn't be worked out (NaN) are left empty
+            row += [None if value is None or not np.isfinite(value) else value for value in percentiles]
+        self.operations.append(('new', galaxy_name, row + [None] * (FIT_COLUMNS - len(row))))
+
+    def clear_fits(self, galaxy_name, fit_type):
+        self.operations.append(('clear', galaxy_name, fit_type))
+
+    def commit(self):
+        if self.operations:
+            backend().apply_fit_operations(self.operations)
+        self.operations = []
+
+    def rollback(self):
+        self.operations = []
 
-    found = False
-
-    # Find galaxy name
-    cur_row = 2
-    going_for_a_while = 0
-    while found == False:
-        if sheet.cell(row=cur_row, column=1).value == galaxy_name:
-            found = True
-        elif sheet.cell(row=cur_row, column=1).value != None:
-            going_for_a_while = 0
-        cur_row += 1
-        going_for_a_while += 1
-        if going_for_a_while > 20:
-            return None
-    cur_row -= 1
-
-    # Iterate over rows and remove them if they contain the fit type
-    name_row = cur_row
-    replace = True
-    end = False
-    while end is False:
-        if sheet.cell(row=cur_row, column=2).value == fit_type:
-            sheet.delete_rows(cur_row)
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
         else:
-            cur_row += 1
-            going_for_a_while += 1
-        if (sheet.cell(row=cur_row, column=1).value != None) or (sheet.cell(row=cur_row, column=2).value == None):
-            if name_row == cur_row:
-                replace = False
-            end = True
+            self.rollback()
+        return False
+
+
+def percentile_header(i):
+    # Label of the ith percentile column of "Fit Parameters" (e.g. "P1 16%")
+    return "P" + str(i//len(PERCENTILE_LABELS) + 1) + " " + PERCENTILE_LABELS[i % len(PERCENTILE_LABELS)]
+
+
+def _apply_fit_operations(operations):
+    # Applies queued FitTransaction operations to the "Fit Parameters" sheet in one pass: the sheet is read into a
+    # FitTable and every operation is applied to that.  The sheet then has the same whole rows inserted and deleted
+    # (so formatting and anything past the fit columns stay with their fit), and only the cells whose value changed
+    # are written.  The parsed copy used by the read functions gets the same changes, rather than being parsed again.
+    stamp = session.file_stamp()
+    wb = session.workbook(read_only=False)
+    sheet = wb.get_sheet_by_name("Fit Parameters")
+
+    try:
+        rows = [list(row) + [None] * (FIT_COLUMNS - len(row))
+                for row in sheet.iter_rows(min_row=2, max_col=FIT_COLUMNS, values_only=True)]
+        fit_table = FitTable(rows)
+        edits = fit_table.apply(operations)
+
+        # Label the percentile columns if this is the first time they're used
+        if any(operation[0] == 'new' and any(value is not None for value in operation[2][8:])
+               for operation in operations):
+            for i in range(FIT_COLUMNS - 8):
+                if sheet.cell(row=1, column=9+i).value is None:
+                    sheet.cell(row=1, column=9+i).value = percentile_header(i)
+
+        for edit, index in edits:
+            if edit == 'insert':
+                sheet.insert_rows(index + 2)
+            else:
+                sheet.delete_rows(index + 2)
+        for i in range(len(fit_table.rows)):
+            for j in range(FIT_COLUMNS):
+                if sheet.cell(row=i+2, column=j+1).value != fit_table.rows[i][j]:
+                    sheet.cell(row=i+2, column=j+1).value = fit_table.rows[i][j]
 
-    # Replace name if it was deleted
-    if replace is True:
-        sheet.cell(row=name_row, column=1).value = galaxy_name
+        session.save(wb)
+    except:
+        # The cached copy may be half-modified, so drop it; the file itself hasn't been touched
+        session.close(False)
+        raise
+
+    if _workbook_data is not None and _workbook_data.stamp == stamp:
+        _workbook_data.fit_table.apply(operations)
+        _workbook_data.stamp = session.file_stamp()
+        _workbook_data.digest = file_digest(session.location)
+        _save_sidecar(_workbook_data)
 
-    wb.save(spreadsheet_loc)
 
 # FOLLOWING: Read functions
 
 def get_set_n(n):  # Assumes LINES_PER_DATA_SET (constant) lines of data per galaxy
     # Puts data from the nth galaxy data set (on sheet named "SEDs") into a Galaxy class (returns Galaxy class)
 
-    wb = opxl.load_workbook(spreadsheet_loc, data_only=True, read_only=True)
-    sheet = wb.get_sheet_by_name("SEDs")
-
-    init_row = 2 + (n*(LINES_PER_DATA_SET+1))
-    reached_end = False
-    col = 3
-
-    # Iterate over the lists of values
-    galaxy_name = sheet["A" + str(init_row)].value
-    num_lists = 5
-    lists = []
-    for i in range(num_lists):
-        lists.append([])
-        while reached_end is False:
-            if sheet.cell(row=init_row+i, column=col).value is not None:
-                cur_val = sheet.cell(row=init_row+i, column=col).value
-                if type(cur_val) is str:
-                    if ("None" in cur_val) or ("none" in cur_val):
-                        lists[i].append(0.0)
-                    else:
-                        lists[i].append(cur_val)
-                else:
-                    lists[i].append(cur_val)
-            else:
-                reached_end = True
-            col += 1
-        col = 3
-        reached_end = False
+    return catalog().galaxy(n)
+
 
-    # Get redshift and distance
-    z = sheet["C" + str(init_row+5)].value
-    distance = sheet["C" + str(init_row+6)].value
+def get_set_named(galaxy_name):
+    # Same as get_set_n, but looks the galaxy up by name, reading only that galaxy where the backend can (see
+    # file_read.CsvBackend)
 
-    # Create galaxy and return it
-    g = galaxy.Galaxy(galaxy_name, lists[0], lists[1], lists[2],
-                      lists[3], lists[4], z, distance)
-    return g
+    return backend().galaxy_named(galaxy_name)
 
 def read_fits(galaxy_name):
-    fit_list = []
+    return [row[1:8] for row in backend().fit_rows(galaxy_name)]
 
-    wb = opxl.load_workbook(spreadsheet_loc, data_only=True, read_only=True)
-    sheet = wb.get_sheet_by_name("Fit Parameters")
 
-    found = False
-
-    # Find galaxy name, returning an empty list if the loop goes more than 20 iterations without finding the name.
-    going_for_a_while = 0
-    cur_row = 2
-    while found == False:
-        if sheet.cell(row=cur_row, column=1).value == galaxy_name:
-            found = True
-        cur_row += 1
-        if sheet.cell(row=cur_row, column=1).value == None:
-            going_for_a_while += 1
+def read_fit_percentiles(galaxy_name):
+    # Returns the saved parameter percentiles of each fit in read_fits(galaxy_name), flattened as in
+    # monte_carlo.summarize, or None for fits saved without them
+    percentiles = []
+    for row in backend().fit_rows(galaxy_name):
+        if all(value is None for value in row[8:]):
+            percentiles.append(None)
         else:
-            going_for_a_while = 0
-        if going_for_a_while > 20:
-            return fit_list
-    cur_row -= 1
-
-    # Populate fit_list
-    end = False
-    while end is False:
-        cur_list = []
-        for i in range(2, 9):
-            cur_list.append(sheet.cell(row=cur_row, column=i).value)
-        fit_list.append(cur_list)
-        if (sheet.cell(row=cur_row + 1, column=1).value != None) or (sheet.cell(row=cur_row + 1, column=2).value == None):
-            end = True
-        cur_row += 1
-
-    if fit_list[0][0] == None:
-        return []
-    else:
-        return fit_list
+            percentiles.append(row[8:])
+    return percentiles
 
 # Returns a list of targets based on the SEDs spreadsheet
 def target_list():
-    wb = opxl.load_workbook(spreadsheet_loc, data_only=True, read_only=True)
-    sheet = wb.get_sheet_by_name("SEDs")
-
-    name_list = []
-
-    loop = True
-    cur_row = 2
-    while loop is True:
-        name_list.append(sheet.cell(row=cur_row, column=1).value)
-        cur_row += LINES_PER_DATA_SET + 1
-        if sheet.cell(row=cur_row, column=1).value is None:
-            loop = False
+    return list(catalog().names)
+
+def matches_filter(name, z, point_telescopes, names=None, z_range=None, telescopes=None):
+    # Whether a galaxy is one of 'names', has z_range[0] <= z <= z_range[1], and has a point from any of
+    # 'telescopes', skipping any of these left as None
+    if names is not None and name not in names:
+        return False
+    if z_range is not None and not (z_range[0] <= z <= z_range[1]):
+        return False
+    if telescopes is not None and not any(telescope in telescopes for telescope in point_telescopes):
+        return False
+    return True
+
+
+def iter_galaxies(names=None, z_range=None, telescopes=None):
+    # Yields the galaxies one at a time as Galaxy classes, only building the ones that pass matches_filter.  Backends
+    # stream them from storage where they can (see WorkbookBackend.iter_galaxies), holding one data set at a time.
+    if names is not None:
+        names = set(names)
+    return backend().iter_galaxies(names=names, z_range=z_range, telescopes=telescopes)
+
+
+def catalog_galaxies(c, names=None, z_range=None, telescopes=None):
+    # Same as iter_galaxies, for an SedCatalog already in memory
+    for n in range(len(c)):
+        if matches_filter(c.names[n], c.z[n], c.telescopes[c.offsets[n]:c.offsets[n+1]], names=names,
+                          z_range=z_range, telescopes=telescopes):
+            yield c.galaxy(n)
+
+
+def sheet_galaxies(rows, names=None, z_range=None, telescopes=None):
+    # Same as iter_galaxies, for the rows of the "SEDs" sheet (from row 1, e.g. a read-only worksheet's iter_rows).
+    # Each data set is built as soon as its rows have been read, so only one is held at a time.
+    block = []
+    for row in itertools.islice(rows, 1, None):
+        if len(row) > 0 and row[0] is not None and len(block) > 0:  # The next data set's name
+            g = _block_galaxy(block, names, z_range, telescopes)
+            if g is not None:
+                yield g
+            block = []
+        if len(block) > 0 or (len(row) > 0 and row[0] is not None):
+            block.append(row)
+    if len(block) > 0:
+        g = _block_galaxy(block, names, z_range, telescopes)
+        if g is not None:
+            yield g
+
+
+def _block_galaxy(block, names, z_range, telescopes):
+    # Builds the Galaxy of one data set's rows if it passes matches_filter (None otherwise)
+    if names is not None and block[0][0] not in names:
+        return None
+    g = SedCatalog.from_rows([()] + block, len(block)).galaxy(0)
+    if matches_filter(g.name, g.z, g.raw_telescopes, z_range=z_range, telescopes=telescopes):
+        return g
+    return None
 
-    return name_list
 
 def get_point_styles():
-    wb = opxl.load_workbook(spreadsheet_loc, data_only=True, read_only=True)
-    sheet = wb.get_sheet_by_name("Point Styles")
-
-    # Define first row and column
-    row_start = 1
-    column_start = 2
-
-    # Populate the list to return, going from top to bottom
-    column = column_start
-    end_row = False
-    comp_list = []
-    for row in range(row_start, row_start+3):
-        comp_list.append([])
-        while end_row is False:
-            comp_list[row-row_start].append(sheet.cell(row=row, column=column).value)
-            if sheet.cell(row=row, column=column+1).value == None:
-                end_row = True
-            column += 1
-        end_row = False
-        column = column_start
-
-    return comp_list
+    return [list(row) for row in backend().point_styles()]
@@ -0,0 +1,319 @@
+import os
+import sqlite3
+import numpy as np
+import startup
+import spreadsheet_interface as spin
+
+opxl = startup.lazy_import("openpyxl")  # Only needed to export a workbook
+
+
+# FOLLOWING: Constants
+FIT_FIELDS = (["fit_type", "param_1", "param_2", "param_3", "range_start", "range_end", "linestyle"] +
+              ["percentile_" + str(i + 1) for i in range(spin.FIT_COLUMNS - 8)])  # Columns B on of "Fit Parameters"
+SED_LABELS = ["Frequency", "Telescope", "Flux", "Unc upper", "Unc lower", "z", "Distance"]  # Column B of each data set
+FIT_HEADERS = ["Galaxy", "Type", "P1", "P2", "P3", "Start", "End", "Line"]
+POINT_FIELDS = "freq, telescope, flux, unc_upper, unc_lower, upper_limit, lower_limit"  # Of a Galaxy, in order
+BUSY_TIMEOUT = 30  # Seconds to wait for another session's write to finish
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value
+);
+CREATE TABLE IF NOT EXISTS galaxies (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    z REAL,
+    distance REAL
+);
+CREATE INDEX IF NOT EXISTS galaxies_name ON galaxies (name);
+CREATE TABLE IF NOT EXISTS photometry (
+    galaxy_id INTEGER NOT NULL REFERENCES galaxies(id),
+    position INTEGER NOT NULL,
+    freq REAL,
+    telescope TEXT,
+    flux REAL,
+    unc_upper REAL,
+    unc_lower REAL,
+    upper_limit INTEGER NOT NULL,
+    lower_limit INTEGER NOT NULL,
+    PRIMARY KEY (galaxy_id, position)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS fits (
+    id INTEGER PRIMARY KEY,
+    galaxy TEXT NOT NULL,
+""" + ",\n".join("    " + field for field in FIT_FIELDS) + """
+);
+CREATE INDEX IF NOT EXISTS fits_galaxy_type ON fits (galaxy, fit_type);
+CREATE TABLE IF NOT EXISTS point_styles (
+    row INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    value TEXT,
+    PRIMARY KEY (row, position)
+) WITHOUT ROWID;
+"""
+
+
+# FOLLOWING: SQLite backend
+
+class SqliteBackend:
+    # Keeps the SEDs, fits and point styles in an SQLite database instead of the workbook (see
+    # spin.WorkbookBackend for the methods every backend has).  Use as
+    #     spin.use_backend(sqlite_backend.SqliteBackend(location))
+    # Each galaxy's points are rows of 'photometry' keyed by (galaxy id, position), and each saved fit is one row of
+    # 'fits', indexed by galaxy, so saving a fit is a single-row insert instead of rewriting a workbook.  The database
+    # runs in WAL mode, so any number of sessions can read while one writes, and writers wait their turn instead of
+    # overwriting each other.  The catalog is read once and kept until the photometry is imported again.
+
+    def __init__(self, location):
+        self.location = location
+        self._connection = None
+        self._pid = None  # Process the connection was opened in
+        self._catalog = None
+        self._catalog_version = None
+
+    def connection(self):
+        # Opened on first use in each process.  A connection can't be used across a fork, so a forked worker process
+        # opens its own instead of the one inherited from the parent (which is left open, since the parent still
+        # uses it).
+        if self._connection is None or self._pid != os.getpid():
+            connection = sqlite3.connect(self.location, timeout=BUSY_TIMEOUT)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("PRAGMA foreign_keys=ON")
+            connection.executescript(SCHEMA)
+            self._connection = connection
+            self._pid = os.getpid()
+        return self._connection
+
+    def close(self):
+        if self._connection is not None and self._pid == os.getpid():
+            self._connection.close()
+        self._connection = None
+
+    def __getstate__(self):
+        # Only the location is handed to spawned worker processes, which open their own connection
+        return {"location": self.location}
+
+    def __setstate__(self, state):
+        self.__init__(state["location"])
+
+    def _meta(self, key, default=None):
+        row = self.connection().execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return default if row is None else row[0]
+
+    # FOLLOWING: Reading
+
+    def catalog(self):
+        catalog_version = self._meta("catalog_version", 0)
+        if self._catalog is not None and self._catalog_version == catalog_version:
+            return self._catalog
+
+        connection = self.connection()
+        galaxies = connection.execute("SELECT id, name, z, distance FROM galaxies ORDER BY id").fetchall()
+        points = connection.execute("SELECT galaxy_id, " + POINT_FIELDS + " FROM photometry "
+                                    "ORDER BY galaxy_id, position").fetchall()
+        self._catalog = _sed_catalog(galaxies, points)
+        self._catalog_version = catalog_version
+        return self._catalog
+
+    def galaxy_named(self, galaxy_name):
+        # Reads only that galaxy's row and points, unless the whole catalog is already in memory
+        if self._catalog is not None and self._catalog_version == self._meta("catalog_version", 0):
+            return self._catalog.galaxy_named(galaxy_name)
+
+        connection = self.connection()
+        galaxy = connection.execute("SELECT id, name, z, distance FROM galaxies WHERE name = ? ORDER BY id LIMIT 1",
+                                    (galaxy_name,)).fetchone()
+        if galaxy is None:
+            raise KeyError(galaxy_name)
+        points = connection.execute("SELECT galaxy_id, " + POINT_FIELDS + " FROM photometry WHERE galaxy_id = ? "
+                                    "ORDER BY position", (galaxy[0],)).fetchall()
+        return _sed_catalog([galaxy], points).galaxy(0)
+
+    def iter_galaxies(self, names=None, z_range=None, telescopes=None):
+        # Streams the galaxies from the database, reading one galaxy's points at a time (by its photometry key)
+        connection = self.connection()
+        for galaxy in connection.execute("SELECT id, name, z, distance FROM galaxies ORDER BY id").fetchall():
+            z = np.nan if galaxy[2] is None else galaxy[2]
+            if not spin.matches_filter(galaxy[1], z, (), names=names, z_range=z_range):
+                continue
+            points = connection.execute("SELECT galaxy_id, " + POINT_FIELDS + " FROM photometry WHERE galaxy_id = ? "
+                                        "ORDER BY position", (galaxy[0],)).fetchall()
+            g = _sed_catalog([galaxy], points).galaxy(0)
+            if spin.matches_filter(g.name, g.z, g.raw_telescopes, telescopes=telescopes):
+                yield g
+
+    def fit_rows(self, galaxy_name):
+        rows = self.connection().execute("SELECT " + ", ".join(FIT_FIELDS) + " FROM fits WHERE galaxy = ? "
+                                         "ORDER BY id", (galaxy_name,)).fetchall()
+        return [[galaxy_name] + list(row) for row in rows]
+
+    def point_styles(self):
+        point_styles = [[], [], []]
+        for row, value in self.connection().execute("SELECT row, value FROM point_styles ORDER BY row, position"):
+            point_styles[row].append(value)
+        return point_styles
+
+    # FOLLOWING: Writing
+
+    def apply_fit_operations(self, operations):
+        # Applies queued FitTransaction operations in one SQLite transaction: a single-row insert per new fit and a
+        # delete per cleared fit type
+        insert = ("INSERT INTO fits (galaxy, " + ", ".join(FIT_FIELDS) + ") VALUES (?" +
+                  ", ?" * len(FIT_FIELDS) + ")")
+        with self.connection() as connection:
+            for operation in operations:
+                if operation[0] == 'clear':
+                    connection.execute("DELETE FROM fits WHERE galaxy = ? AND fit_type = ?", operation[1:3])
+                else:
+                    connection.execute(insert, [operation[1]] + [_sql_value(value) for value in operation[2][1:]])
+
+    # FOLLOWING: Workbook import and export
+
+    def import_workbook(self, data=None):
+        # Replaces the database's contents with a parsed workbook (spin.workbook_data() by default)
+        if data is None:
+            data = spin.workbook_data()
+        c = data.catalog
+
+        with self.connection() as connection:
+            for table in ("photometry", "galaxies", "fits", "point_styles"):
+                connection.execute("DELETE FROM " + table)
+
+            connection.executemany("INSERT INTO galaxies (id, name, z, distance) VALUES (?, ?, ?, ?)",
+                                   [(n, c.names[n], _sql_value(c.z[n]), _sql_value(c.distance[n]))
+                                    for n in range(len(c))])
+            points = []
+            for n in range(len(c)):
+                for i in range(c.offsets[n], c.offsets[n+1]):
+                    points.append((n, int(i - c.offsets[n]), _sql_value(c.freq[i]), c.telescopes[i],
+                                   _sql_value(c.flux[i]), _sql_value(c.unc_upper[i]), _sql_value(c.unc_lower[i]),
+                                   int(c.upper_limits[i]), int(c.lower_limits[i])))
+            connection.executemany("INSERT INTO photometry VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", points)
+
+            # Sections are added in the order they're in on the sheet, so exporting keeps that order
+            fits = []
+            for galaxy_name, span in sorted(data.fit_table.spans.items(), key=lambda item: item[1]):
+                for row in data.fit_table.fits(galaxy_name):
+                    fits.append([galaxy_name] + [_sql_value(value) for value in row[1:]])
+            connection.executemany("INSERT INTO fits (galaxy, " + ", ".join(FIT_FIELDS) + ") VALUES (?" +
+                                   ", ?" * len(FIT_FIELDS) + ")", fits)
+
+            connection.executemany("INSERT INTO point_styles VALUES (?, ?, ?)",
+                                   [(row, position, data.point_styles[row][position])
+                                    for row in range(len(data.point_styles))
+                                    for position in range(len(data.point_styles[row]))])
+
+            connection.execute("INSERT OR REPLACE INTO meta VALUES ('lines_per_data_set', ?)",
+                               (data.lines_per_data_set,))
+            connection.execute("INSERT OR REPLACE INTO meta VALUES ('catalog_version', ?)",
+                               (self._meta("catalog_version", 0) + 1,))
+
+    def export_workbook(self, location, template=None):
+        # Writes the database out in the workbook layout ("SEDs", "Fit Parameters" and "Point Styles") to location.
+        # With a template workbook (e.g. spin.spreadsheet_loc), its other sheets, header rows, labels and formatting
+        # are kept and only the data is replaced.
+        c = self.catalog()
+        lines_per_data_set = self._meta("lines_per_data_set", len(SED_LABELS))
+
+        if template is not None:
+            wb = opxl.load_workbook(template)
+        else:
+            wb = opxl.Workbook()
+            wb.remove(wb.active)
+        for title in ("SEDs", "Fit Parameters", "Point Styles"):
+            if title not in wb.sheetnames:
+                wb.create_sheet(title)
+
+        # SEDs, using the template's labels from its first data set if it has any
+        sheet = wb["SEDs"]
+        labels = [sheet.cell(row=2+k, column=2).value for k in range(lines_per_data_set)]
+        if all(label is None for label in labels):
+            labels = (SED_LABELS + [None] * lines_per_data_set)[:lines_per_data_set]
+        if sheet.max_row > 1:
+            sheet.delete_rows(2, sheet.max_row - 1)
+        if sheet.cell(row=1, column=1).value is None:
+            sheet.cell(row=1, column=1).value = "Galaxy"
+        for n in range(len(c)):
+            init_row = 2 + n * (lines_per_data_set + 1)
+            start, end = c.offsets[n], c.offsets[n+1]
+            sheet.cell(row=init_row, column=1).value = c.names[n]
+            for k in range(lines_per_data_set):
+                sheet.cell(row=init_row + k, column=2).value = labels[k]
+            data_rows = [c.freq[start:end], c.telescopes[start:end], c.flux[start:end],
+                         _limit_values(c.unc_upper[start:end], c.upper_limits[start:end]),
+                         _limit_values(c.unc_lower[start:end], c.lower_limits[start:end])]
+            for k in range(len(data_rows)):
+                for i in range(end - start):
+                    sheet.cell(row=init_row + k, column=3 + i).value = _cell_value(data_rows[k][i])
+            sheet.cell(row=init_row + 5, column=3).value = _cell_value(c.z[n])
+            sheet.cell(row=init_row + 6, column=3).value = _cell_value(c.distance[n])
+
+        # Fit Parameters, one section per galaxy with its name on the first row
+        sheet = wb["Fit Parameters"]
+        if sheet.max_row > 1:
+            sheet.delete_rows(2, sheet.max_row - 1)
+        headers = FIT_HEADERS + [spin.percentile_header(i) for i in range(spin.FIT_COLUMNS - 8)]
+        for j in range(spin.FIT_COLUMNS):
+            if sheet.cell(row=1, column=j+1).value is None:
+                sheet.cell(row=1, column=j+1).value = headers[j]
+        sections = {}  # Galaxy name -> its fits, in the order each galaxy's first fit was saved
+        for fit in self.connection().execute("SELECT galaxy, " + ", ".join(FIT_FIELDS) + " FROM fits ORDER BY id"):
+            sections.setdefault(fit[0], []).append(list(fit[1:]))
+        row_number = 2
+        for galaxy_name, section in sections.items():
+            for i in range(len(section)):
+                values = [galaxy_name if i == 0 else None] + section[i]
+                for j in range(spin.FIT_COLUMNS):
+                    sheet.cell(row=row_number, column=j+1).value = values[j]
+                row_number += 1
+
+        # Point Styles, rows 1 to 3 from column B
+        sheet = wb["Point Styles"]
+        point_styles = self.point_styles()
+        for row in range(len(point_styles)):
+            for column in range(2, sheet.max_column + 1):
+                sheet.cell(row=row+1, column=column).value = None
+            for position in range(len(point_styles[row])):
+                sheet.cell(row=row+1, column=position+2).value = point_styles[row][position]
+
+        spin.atomic_save(location, wb.save)
+        return location
+
+
+# FOLLOWING: Value conversion
+
+def _sed_catalog(galaxies, points):
+    # Builds a spin.SedCatalog from (id, name, z, distance) galaxy rows and (galaxy_id, POINT_FIELDS...) photometry
+    # rows, both sorted by galaxy id
+    point_ids = np.array([point[0] for point in points], dtype=np.int64)
+    offsets = np.append(np.searchsorted(point_ids, [galaxy[0] for galaxy in galaxies]), len(points))
+    columns = list(zip(*points)) if points else [()] * 8
+    return spin.SedCatalog([galaxy[1] for galaxy in galaxies], offsets, np.array(columns[1], dtype=float),
+                           np.array(columns[2], dtype=object), np.array(columns[3], dtype=float),
+                           np.array(columns[4], dtype=float), np.array(columns[5], dtype=float),
+                           np.array(columns[6], dtype=bool), np.array(columns[7], dtype=bool),
+                           np.array([galaxy[2] for galaxy in galaxies], dtype=float),
+                           np.array([galaxy[3] for galaxy in galaxies], dtype=float))
+
+
+def _sql_value(value):
+    # NaN and numpy scalars become what SQLite stores (NULL, Python floats and ints)
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    return value
+
+
+def _cell_value(value):
+    # NaN becomes an empty cell, and whole numbers are written as ints (as they're typed on the sheets)
+    value = _sql_value(value)
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def _limit_values(uncertainties, limits):
+    return ['Limit' if limits[i] else uncertainties[i] for i in range(len(uncertainties))]
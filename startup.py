@@ -0,0 +1,51 @@
+import time
+import importlib
+
+# FOLLOWING: Lazy imports and startup profiling
+
+_start = time.perf_counter()  # Taken when main first imports this module
+timings = []  # (label, seconds) for each lazy import and startup mark, in the order they happened
+
+
+class LazyModule:
+    # Stands in for a module until one of its attributes is used, then imports it.  The import time (including any
+    # modules it pulls in) is recorded in timings for report().
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            start = time.perf_counter()
+            self._module = importlib.import_module(self._name)
+            timings.append(("import " + self._name, time.perf_counter() - start))
+        return self._module
+
+    def __getattr__(self, attribute):
+        return getattr(self._load(), attribute)
+
+
+def lazy_import(name):
+    return LazyModule(name)
+
+
+def is_loaded(module):
+    # Whether a LazyModule has been imported yet (a regular module always has)
+    return not isinstance(module, LazyModule) or module._module is not None
+
+
+def mark(label):
+    # Records the time since startup the first time label is reached (e.g. the first menu prompt)
+    for timing in timings:
+        if timing[0] == label:
+            return None
+    timings.append((label, time.perf_counter() - _start))
+
+
+def report():
+    lines = ["Startup profile (seconds):"]
+    for label, seconds in timings:
+        lines.append("\t" + label + ": " + str(round(seconds, 3)))
+    lines.append("\ttotal run time: " + str(round(time.perf_counter() - _start, 3)))
+    return "\n".join(lines)